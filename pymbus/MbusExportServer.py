@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  MbusExportServer.py
+#
+#  Copyright 2024  <pi@raspberrypi>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+import json
+import math
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from MbusTcpMaster import MbusTcpMaster, MbusPoller, SlaveHealth
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(module)s:%(funcName)s - %(message)s')
+handler.setFormatter(formatter)
+_logger.addHandler(handler)
+_logger.setLevel(logging.INFO)
+
+
+# Modbus exception codes
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+ILLEGAL_DATA_VALUE = 0x03
+GATEWAY_TARGET_FAILED = 0x0B
+
+# Units of the cumulative counters (energy, volume, mass), a float32 loses digits of these above about 1.6e7
+COUNTER_UNITS = ['Wh', 'J', 'm3', 'kg']
+INT32_INVALID = -0x80000000
+# register encoding: (number of registers, struct format)
+REGISTER_TYPES = {'float32':(2, '>f'), 'float64':(4, '>d'), 'int32':(2, '>i')}
+
+class MeterImage(object):
+	'''
+	The latest values of all polled meters, kept in the form in which they are served:
+	a Modbus register image (big endian) and JSON documents.
+	The Modbus unit id is the primary Mbus address of the meter, the fields of its readout follow each other in the register map.
+	Fields take 2 registers (IEEE754 float32), counters (energy, volume, mass) are encoded as counter_format.
+	The position and type of a field are fixed at its first appearance, so the register map stays stable between readouts.
+	Fields that are not numeric (dates, strings) are served as NaN, an int32 that is invalid or out of range as -2**31.
+	
+	kwargs:
+	counter_format: 'float64' (4 registers), 'int32' (2 registers, value * 10**counter_decimals) or 'float32' (str:'float64')
+	counter_decimals: Number of decimals of the int32 counters (int:3)
+	'''
+	def __init__(self, **kwargs):
+		# Optional args with their defaults
+		self.counter_format = kwargs.pop('counter_format', 'float64')
+		self.counter_decimals = kwargs.pop('counter_decimals', 3)
+		if self.counter_format not in REGISTER_TYPES: raise ValueError(f'Unknown counter_format {self.counter_format}')
+		
+		self._lock = threading.Lock()
+		self.layout = dict()				# slave_address: {descr: (register, type)}
+		self.next_register = dict()			# slave_address: first free register
+		self.registers = dict()				# slave_address: bytes, 2 bytes per register
+		self.documents = dict()				# slave_address: JSON bytes
+		self.document_all = b'{}'
+		self.layout_document = b'{}'
+
+	def update(self, slave_address, results):
+		'''
+		Listener for MbusPoller, (re)builds the served images of one meter
+		'''
+		with self._lock:
+			layout = self.layout.setdefault(slave_address, dict())
+			values = dict()
+			for field in results.get('fields', []):
+				if field['descr'] not in layout:
+					register_type = self.counter_format if field.get('unit') in COUNTER_UNITS else 'float32'
+					layout[field['descr']] = (self.next_register.get(slave_address, 0), register_type)
+					self.next_register[slave_address] = self.next_register.get(slave_address, 0) + REGISTER_TYPES[register_type][0]
+				value = field['value']
+				values[field['descr']] = value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+			image = bytearray(2 * self.next_register.get(slave_address, 0))
+			for descr, (register, register_type) in layout.items():
+				struct.pack_into(REGISTER_TYPES[register_type][1], image, 2 * register, self._encode(values.get(descr), register_type))
+
+			self.registers[slave_address] = bytes(image)
+			self.documents[slave_address] = json.dumps(results, default=str).encode()
+			self.document_all = b'{' + b','.join(b'"%d":%s' % (addr, doc) for addr, doc in sorted(self.documents.items())) + b'}'
+			self.layout_document = json.dumps({addr: {descr: self._describe(reg, register_type) for descr, (reg, register_type) in fields.items()} for addr, fields in self.layout.items()}).encode()
+
+	def _encode(self, value, register_type):
+		if register_type != 'int32': return math.nan if value is None else float(value)
+		if value is None: return INT32_INVALID
+		scaled = round(value * 10**self.counter_decimals)
+		return scaled if INT32_INVALID < scaled <= 0x7FFFFFFF else INT32_INVALID
+
+	def _describe(self, register, register_type):
+		description = {'register': register, 'count': REGISTER_TYPES[register_type][0], 'type': register_type}
+		if register_type == 'int32': description['scale'] = 10**-self.counter_decimals
+		return description
+
+	def read_registers(self, slave_address, start, count):
+		'''
+		returns: The requested registers as bytes, or a Modbus exception code
+		'''
+		image = self.registers.get(slave_address)
+		if image is None: return GATEWAY_TARGET_FAILED
+		if count < 1 or count > 125: return ILLEGAL_DATA_VALUE
+		if 2 * (start + count) > len(image): return ILLEGAL_DATA_ADDRESS
+		return image[2 * start:2 * (start + count)]
+
+
+class ModbusHandler(socketserver.BaseRequestHandler):
+	'''
+	Modbus-TCP requests (read holding registers 0x03 and read input registers 0x04), answered from the MeterImage
+	'''
+	def handle(self):
+		image = self.server.image
+		sock = self.request
+		buffer = b''
+		while True:
+			try:
+				data = sock.recv(1024)
+			except OSError:
+				return
+			if not data: return
+			buffer += data
+			while len(buffer) >= 7:
+				tid, pid, length, unit = struct.unpack('>HHHB', buffer[:7])
+				if len(buffer) < 6 + length: break
+				pdu, buffer = buffer[7:6 + length], buffer[6 + length:]
+				function = pdu[0] if pdu else 0
+				if function in [0x03, 0x04] and len(pdu) == 5:
+					start, count = struct.unpack('>HH', pdu[1:5])
+					result = image.read_registers(unit, start, count)
+					if isinstance(result, int):
+						reply = bytes([function | 0x80, result])
+					else:
+						reply = bytes([function, len(result)]) + result
+				else:
+					reply = bytes([function | 0x80, ILLEGAL_FUNCTION])
+				sock.sendall(struct.pack('>HHHB', tid, pid, len(reply) + 1, unit) + reply)
+
+
+class HttpHandler(BaseHTTPRequestHandler):
+	'''
+	GET /meters, /meters/<address>, /registers and /health, answered from memory
+	'''
+	def do_GET(self):
+		image = self.server.image
+		parts = [x for x in self.path.split('?')[0].split('/') if x]
+		body = None
+		if parts == ['meters']:
+			body = image.document_all
+		elif parts == ['registers']:
+			body = image.layout_document
+		elif parts == ['health'] and self.server.health is not None:
+			body = json.dumps(self.server.health.metrics(), default=str).encode()
+		elif len(parts) == 2 and parts[0] == 'meters' and parts[1].isdigit():
+			body = image.documents.get(int(parts[1]))
+
+		if body is None:
+			self.send_error(404)
+			return
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		_logger.debug(format % args)
+
+
+class ThreadingModbusServer(socketserver.ThreadingTCPServer):
+	allow_reuse_address = True
+	daemon_threads = True
+
+
+class MbusExportServer(object):
+	"""
+	Serves the latest values of an MbusPoller from memory over Modbus-TCP and HTTP (JSON),
+	so any number of clients can read the meters without causing extra bus traffic.
+
+	usage: server = MbusExportServer(poller, [host, modbus_port, http_port, counter_format, counter_decimals])
+
+	kwargs:
+	host: Interface to listen on (str:'0.0.0.0')
+	modbus_port: Port of the Modbus-TCP server, None to disable (int:5020)
+	http_port: Port of the HTTP server, None to disable (int:8080)
+	counter_format: Register encoding of the counters, see MeterImage (str:'float64')
+	counter_decimals: Number of decimals of int32 counters (int:3)
+	"""
+	def __init__(self, poller, **kwargs):
+		# Mandatory args
+		self.poller = poller
+
+		# Optional args with their defaults
+		self.host = kwargs.pop('host', '0.0.0.0')
+		self.modbus_port = kwargs.pop('modbus_port', 5020)
+		self.http_port = kwargs.pop('http_port', 8080)
+
+		# Add non arg properties and their defaults
+		self.image = MeterImage(counter_format=kwargs.pop('counter_format', 'float64'), counter_decimals=kwargs.pop('counter_decimals', 3))
+		self.servers = []
+
+		for slave_address, results in list(self.poller.latest.items()): self.image.update(slave_address, results)
+		self.poller.add_listener(self.image.update)
+
+	def start(self):
+		if self.modbus_port is not None:
+			self.servers.append(ThreadingModbusServer((self.host, self.modbus_port), ModbusHandler))
+		if self.http_port is not None:
+			self.servers.append(ThreadingHTTPServer((self.host, self.http_port), HttpHandler))
+		for server in self.servers:
+			server.image = self.image
+			server.health = self.poller.master.health
+			threading.Thread(target=server.serve_forever, daemon=True).start()
+			_logger.info(f'Serving {server.__class__.__name__} on {server.server_address}')
+		self.poller.start()
+
+	def stop(self):
+		self.poller.stop()
+		for server in self.servers:
+			server.shutdown()
+			server.server_close()
+		self.servers = []
+
+
+
+def main(args):
+	import argparse
+	parser = argparse.ArgumentParser(description='Poll Mbus meters and serve their latest values over Modbus-TCP and HTTP')
+	parser.add_argument('host', help='IP address of the TCP/Mbus bridge')
+	parser.add_argument('port', type=int, help='Port of the TCP/Mbus bridge')
+	parser.add_argument('addresses', type=int, nargs='*', help='Primary addresses to poll, scanned when omitted')
+	parser.add_argument('--interval', type=float, default=60.0, help='Polling interval in seconds')
+	parser.add_argument('--baudrate', type=int, default=2400, help='Baudrate of the Mbus')
+	parser.add_argument('--listen', default='0.0.0.0', help='Interface to serve on')
+	parser.add_argument('--modbus-port', type=int, default=5020)
+	parser.add_argument('--http-port', type=int, default=8080)
+	parser.add_argument('--counter-format', choices=sorted(REGISTER_TYPES), default='float64', help='Register encoding of energy, volume and mass counters')
+	parser.add_argument('--counter-decimals', type=int, default=3, help='Number of decimals of int32 counters')
+	parser.add_argument('--state-file', help='File to keep the slave inventory and circuit breaker states in')
+	options = parser.parse_args(args[1:])
+
+	master = MbusTcpMaster(options.host, options.port, baudrate=options.baudrate, health=SlaveHealth())
+	poller = MbusPoller(master, options.addresses, interval=options.interval, state_file=options.state_file)
+	if not poller.addresses: poller.addresses = list((master.scan_slaves_primary() or {}).keys())
+	server = MbusExportServer(poller, host=options.listen, modbus_port=options.modbus_port, http_port=options.http_port, 
+							counter_format=options.counter_format, counter_decimals=options.counter_decimals)
+	server.start()
+	try:
+		while True: time.sleep(1)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.stop()
+		master.close()
+
+if __name__ == '__main__':
+	import sys
+	sys.exit(main(sys.argv))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  MbusHistory.py
+#
+#  Copyright 2024  <pi@raspberrypi>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+import threading
+from array import array
+from bisect import bisect_left
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(module)s:%(funcName)s - %(message)s')
+handler.setFormatter(formatter)
+_logger.addHandler(handler)
+_logger.setLevel(logging.INFO)
+
+
+class FieldRing(object):
+	'''
+	Fixed capacity ring buffer of (timestamp, value) pairs in two typed (float64) arrays, appends are O(1)
+	and the oldest pair is overwritten when the ring is full
+	'''
+	def __init__(self, capacity):
+		if capacity < 1: raise ValueError(f'Capacity of a ring must be at least 1, not {capacity}')
+		self.capacity = capacity
+		self.timestamps = array('d', bytes(8 * capacity))
+		self.values = array('d', bytes(8 * capacity))
+		self.count = 0
+		self.head = 0										# position of the next append
+
+	def __len__(self):
+		return self.count
+
+	def append(self, timestamp, value):
+		'''
+		returns: The (timestamp, value) pair that was overwritten, None while the ring is not full
+		'''
+		evicted = (self.timestamps[self.head], self.values[self.head]) if self.count == self.capacity else None
+		self.timestamps[self.head] = timestamp
+		self.values[self.head] = value
+		self.head = (self.head + 1) % self.capacity
+		if self.count < self.capacity: self.count += 1
+		return evicted
+
+	def ordered(self):
+		'''
+		returns: (timestamps, values) as arrays, oldest first
+		'''
+		if self.count < self.capacity: return self.timestamps[:self.count], self.values[:self.count]
+		return self.timestamps[self.head:] + self.timestamps[:self.head], self.values[self.head:] + self.values[:self.head]
+
+
+class FieldHistory(object):
+	'''
+	History of one meter field: the last capacity readings, optionally followed (further back in time) by
+	downsampled older readings, every downsample evicted readings are averaged into one pair
+	'''
+	def __init__(self, capacity, downsample=0, downsample_capacity=0):
+		self.recent = FieldRing(capacity)
+		self.downsample = downsample
+		self.older = FieldRing(downsample_capacity) if downsample and downsample_capacity else None
+		self._bucket = [0.0, 0.0, 0]						# sum of timestamps, sum of values, count
+
+	def append(self, timestamp, value):
+		evicted = self.recent.append(timestamp, value)
+		if evicted is None or self.older is None: return
+		self._bucket[0] += evicted[0]
+		self._bucket[1] += evicted[1]
+		self._bucket[2] += 1
+		if self._bucket[2] == self.downsample:
+			self.older.append(self._bucket[0] / self.downsample, self._bucket[1] / self.downsample)
+			self._bucket = [0.0, 0.0, 0]
+
+	def window(self, seconds=None, last=None, now=None):
+		'''
+		returns: (timestamps, values) as arrays, oldest first. Limited to the last number of readings
+		and/or the readings of the last seconds (relative to now, default the newest timestamp)
+		'''
+		timestamps, values = self.recent.ordered()
+		if self.older is not None and len(self.older):
+			older_timestamps, older_values = self.older.ordered()
+			timestamps, values = older_timestamps + timestamps, older_values + values
+		if last == 0: return array('d'), array('d')
+		if last is not None and last < len(values):
+			timestamps, values = timestamps[-last:], values[-last:]
+		if seconds is not None and len(timestamps):
+			start = bisect_left(timestamps, (timestamps[-1] if now is None else now) - seconds)
+			timestamps, values = timestamps[start:], values[start:]
+		return timestamps, values
+
+
+class HistoryStore(object):
+	'''
+	In memory history of every numeric field of the polled meters with fixed memory use, for rules that need
+	the last readings of a field (rate of change, min/max, averages).
+
+	usage: history = HistoryStore([capacity, downsample, downsample_capacity])
+		   poller.add_listener(history.update)
+		   history.stats(slave_address, descr, seconds=3600)
+
+	kwargs:
+	capacity: Number of readings kept per field (int:1024)
+	downsample: Number of evicted readings averaged into one older reading, 0 to drop them (int:0)
+	downsample_capacity: Number of downsampled readings kept per field (int:1024)
+	'''
+	def __init__(self, **kwargs):
+		# Optional args with their defaults
+		self.capacity = kwargs.pop('capacity', 1024)
+		self.downsample = kwargs.pop('downsample', 0)
+		self.downsample_capacity = kwargs.pop('downsample_capacity', 1024)
+		if self.capacity < 1: raise ValueError(f'capacity must be at least 1, not {self.capacity}')
+		if self.downsample and self.downsample_capacity < 1: raise ValueError(f'downsample_capacity must be at least 1 with downsample, not {self.downsample_capacity}')
+
+		# Add non arg properties and their defaults
+		self.fields = dict()								# (slave_address, descr): FieldHistory
+		self._lock = threading.Lock()
+
+	def update(self, slave_address, results):
+		'''
+		Listener for MbusPoller, appends the numeric fields of a readout
+		'''
+		timestamp = results.get('timestamp')
+		if timestamp is None: return
+		with self._lock:
+			for field in results.get('fields', []):
+				value = field['value']
+				if not isinstance(value, (int, float)) or isinstance(value, bool): continue
+				history = self.fields.get((slave_address, field['descr']))
+				if history is None:
+					history = self.fields[(slave_address, field['descr'])] = FieldHistory(self.capacity, self.downsample, self.downsample_capacity)
+				history.append(timestamp, value)
+
+	def window(self, slave_address, descr, seconds=None, last=None, now=None):
+		'''
+		returns: (timestamps, values) as arrays (float64), oldest first, see FieldHistory.window
+		'''
+		with self._lock:
+			history = self.fields.get((slave_address, descr))
+			if history is None: return array('d'), array('d')
+			return history.window(seconds, last, now)
+
+	def mean(self, slave_address, descr, **kwargs):
+		timestamps, values = self.window(slave_address, descr, **kwargs)
+		return sum(values) / len(values) if values else None
+
+	def min(self, slave_address, descr, **kwargs):
+		timestamps, values = self.window(slave_address, descr, **kwargs)
+		return min(values) if values else None
+
+	def max(self, slave_address, descr, **kwargs):
+		timestamps, values = self.window(slave_address, descr, **kwargs)
+		return max(values) if values else None
+
+	def delta(self, slave_address, descr, **kwargs):
+		timestamps, values = self.window(slave_address, descr, **kwargs)
+		return values[-1] - values[0] if values else None
+
+	def rate(self, slave_address, descr, **kwargs):
+		'''
+		returns: Change of the value per second over the window
+		'''
+		timestamps, values = self.window(slave_address, descr, **kwargs)
+		if len(values) < 2 or timestamps[-1] == timestamps[0]: return None
+		return (values[-1] - values[0]) / (timestamps[-1] - timestamps[0])
+
+	def stats(self, slave_address, descr, **kwargs):
+		'''
+		returns: A dictionary with count, mean, min, max, delta and rate over one window
+		'''
+		timestamps, values = self.window(slave_address, descr, **kwargs)
+		if not values: return dict(count=0, mean=None, min=None, max=None, delta=None, rate=None)
+		duration = timestamps[-1] - timestamps[0]
+		return dict(count=len(values), mean=sum(values) / len(values), min=min(values), max=max(values),
+					delta=values[-1] - values[0], rate=(values[-1] - values[0]) / duration if duration else None)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  MbusSharedTable.py
+#
+#  Copyright 2024  <pi@raspberrypi>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+import json
+import math
+import struct
+import time
+from multiprocessing import shared_memory
+
+# --------------------------------------------------------------------------- #
+# Logging
+# --------------------------------------------------------------------------- #
+import logging
+_logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(module)s:%(funcName)s - %(message)s')
+handler.setFormatter(formatter)
+_logger.addHandler(handler)
+_logger.setLevel(logging.INFO)
+
+
+MAGIC = b'MBST'
+_HEADER = struct.Struct('<4sII')					# magic, number of slots, length of the layout (JSON)
+_SEQ = struct.Struct('<Q')
+_VALUE = struct.Struct('<dd')						# timestamp, value
+SLOT_SIZE = _SEQ.size + _VALUE.size
+
+class SharedValueTable(object):
+	'''
+	Latest value per meter field in shared memory, so other processes can read current values without IPC or bus traffic.
+	The layout (one slot per (slave_address, descr)) is fixed when the table is created and stored in the table itself,
+	readers only need its name. Every slot has a sequence counter (seqlock): the writer makes it odd before and even after
+	changing the slot, a reader retries until it read the same even counter before and after the value.
+	Values are stored as float64, fields that are not numeric are stored as NaN.
+
+	usage writer: table = SharedValueTable(name, keys=[(slave_address, descr), ...])
+				  poller.add_listener(table.update)
+	usage reader: table = SharedValueTable(name)
+				  value, timestamp = table.read(slave_address, descr)
+
+	args:
+	name: Name of the shared memory block
+
+	kwargs:
+	keys: The (slave_address, descr) of every slot, creates the table (list:None, attach to an existing table)
+	lock_timeout: Time in seconds a reader waits for a slot the writer is updating (float:1.0)
+	'''
+	def __init__(self, name, **kwargs):
+		# Mandatory args
+		self.name = name
+
+		# Optional args with their defaults
+		keys = kwargs.pop('keys', None)
+		self.lock_timeout = kwargs.pop('lock_timeout', 1.0)
+
+		self.owner = keys is not None
+		if self.owner:
+			keys = [(int(slave_address), descr) for slave_address, descr in keys]
+			layout = json.dumps(keys).encode()
+			self.offset = self._slots_offset(len(layout))
+			self.shm = shared_memory.SharedMemory(name=name, create=True, size=self.offset + SLOT_SIZE * len(keys))
+			self.shm.buf[:self.offset] = bytes(self.offset)
+			_HEADER.pack_into(self.shm.buf, 0, MAGIC, len(keys), len(layout))
+			self.shm.buf[_HEADER.size:_HEADER.size + len(layout)] = layout
+			for slot in range(len(keys)):
+				_SEQ.pack_into(self.shm.buf, self.offset + slot * SLOT_SIZE, 0)
+				_VALUE.pack_into(self.shm.buf, self.offset + slot * SLOT_SIZE + _SEQ.size, 0.0, math.nan)
+		else:
+			self.shm = self._attach(name)
+			magic, nr_slots, layout_length = _HEADER.unpack_from(self.shm.buf, 0)
+			if magic != MAGIC: raise ValueError(f'{name} is not an Mbus shared value table')
+			keys = [tuple(key) for key in json.loads(bytes(self.shm.buf[_HEADER.size:_HEADER.size + layout_length]))]
+			self.offset = self._slots_offset(layout_length)
+
+		self.keys = keys
+		self.index = {key:self.offset + slot * SLOT_SIZE for slot, key in enumerate(keys)}
+
+	def __repr__(self):
+		return f"{self.__class__.__name__}({self.name}): {len(self.keys)} slots, {'writer' if self.owner else 'reader'}"
+
+	@staticmethod
+	def _slots_offset(layout_length):
+		# slots start 8 byte aligned after the header and the layout
+		return (_HEADER.size + layout_length + 7) & ~7
+
+	@staticmethod
+	def _attach(name):
+		# readers must not unlink the block when they exit, the resource tracker does that before Python 3.13
+		try:
+			return shared_memory.SharedMemory(name=name, track=False)
+		except TypeError:
+			shm = shared_memory.SharedMemory(name=name)
+			try:
+				from multiprocessing import resource_tracker
+				resource_tracker.unregister(shm._name, 'shared_memory')
+			except Exception:
+				pass
+			return shm
+
+	@classmethod
+	def for_poller(cls, name, poller):
+		'''
+		Creates a table with a slot for every field the poller has read so far
+		'''
+		keys = [(slave_address, field['descr']) for slave_address, results in sorted(poller.latest.items()) for field in results.get('fields', [])]
+		return cls(name, keys=keys)
+
+	def update(self, slave_address, results):
+		'''
+		Listener for MbusPoller, writes the fields of a readout that have a slot in the table
+		'''
+		buf = self.shm.buf
+		timestamp = results.get('timestamp', 0.0)
+		for field in results.get('fields', []):
+			offset = self.index.get((slave_address, field['descr']))
+			if offset is None: continue
+			value = field['value']
+			value = float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else math.nan
+			seq = _SEQ.unpack_from(buf, offset)[0]
+			_SEQ.pack_into(buf, offset, seq + 1)
+			_VALUE.pack_into(buf, offset + _SEQ.size, timestamp, value)
+			_SEQ.pack_into(buf, offset, seq + 2)
+
+	def read(self, slave_address, descr):
+		'''
+		returns: (value, timestamp) of a field, a consistent pair even while the writer is updating it
+		'''
+		return self._read(self.index[(slave_address, descr)])[1:]
+
+	def version(self, slave_address, descr):
+		'''
+		returns: The number of updates of a field so far, to detect new values without reading them
+		'''
+		return _SEQ.unpack_from(self.shm.buf, self.index[(slave_address, descr)])[0] // 2
+
+	def read_all(self):
+		'''
+		returns: {(slave_address, descr): (value, timestamp)} for all slots
+		'''
+		return {key:self._read(offset)[1:] for key, offset in self.index.items()}
+
+	def _read(self, offset):
+		buf = self.shm.buf
+		give_up = None
+		backoff = 0.0
+		while True:
+			before = _SEQ.unpack_from(buf, offset)[0]
+			if not before & 1:
+				timestamp, value = _VALUE.unpack_from(buf, offset + _SEQ.size)
+				if _SEQ.unpack_from(buf, offset)[0] == before: return before, value, timestamp
+			# the writer may be preempted halfway an update, let it run
+			if give_up is None: give_up = time.monotonic() + self.lock_timeout
+			elif time.monotonic() > give_up: break
+			time.sleep(backoff)
+			backoff = min(0.001, backoff * 2 or 0.00005)
+		# the writer stopped halfway an update
+		raise RuntimeError(f'Slot at offset {offset} of {self.name} stays locked for {self.lock_timeout} seconds')
+
+	def close(self):
+		'''
+		Detaches from the table, the writer also removes it
+		'''
+		self.index = {}
+		self.shm.close()
+		if self.owner: self.shm.unlink()
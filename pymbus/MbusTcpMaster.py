@@ -22,12 +22,18 @@
 #  
 #  
 import os
+import json
 
 
 
 import socket
 import threading
 import time
+import heapq
+import struct
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
 from enum import Enum
 from datetime import datetime, date
 
@@ -47,6 +53,40 @@ _logger.setLevel(logging.INFO)
 field_names = {0x01:[], 0x02:[]}
 
 
+class MbusError(Exception):
+	'''
+	Base class of all Mbus communication errors
+	'''
+
+class MbusTimeoutError(MbusError, socket.timeout):
+	'''
+	No (complete) response within the response timeout or the budget of the transaction
+	'''
+
+class MbusChecksumError(MbusError):
+	'''
+	The checksum of the received telegram does not match its contents
+	'''
+
+class MbusFramingError(MbusError):
+	'''
+	Invalid start byte, length fields or stop byte, or a response from another address
+	'''
+
+class MbusNakError(MbusError):
+	'''
+	The slave answered with a negative acknowledge (0xA2)
+	'''
+
+class MbusApplicationError(MbusError):
+	'''
+	The slave answered with an application error (RSP_UD with CI 0x70)
+	'''
+
+# Errors of the transmission itself, a transaction is repeated (with the same FCB) when one of these occurs
+retry_errors = (MbusTimeoutError, MbusChecksumError, MbusFramingError, MbusNakError)
+
+
 
 class Medium_field(Enum):
 	Other = 0x00
@@ -79,6 +119,9 @@ class Status_field(Enum):
 	Any_application_error = 2
 	Reserved = 3
 
+# Status bits 2..4 of the FDH status byte
+Status_flags = {0x04:'Power_low', 0x08:'Permanent_error', 0x10:'Temporary_error'}
+
 class Function_field(Enum):
 	'''
 	Describes the function bits (6 and 5) in the first DIF
@@ -88,44 +131,86 @@ class Function_field(Enum):
 	Max = 0b01
 	Err = 0b11
 	
+# Precompiled structs for the binary data codings (little endian, signed: EN13757-3 type B and H)
+_INT8 = struct.Struct('<b')
+_INT16 = struct.Struct('<h')
+_INT24 = struct.Struct('<Hb')										# no 3 byte struct format, low word + signed high byte
+_INT32 = struct.Struct('<i')
+_FLOAT32 = struct.Struct('<f')
+_INT48 = struct.Struct('<Ih')										# no 6 byte struct format, low dword + signed high word
+_INT64 = struct.Struct('<q')
+
+# BCD value (0..99) per byte, None when one of the nibbles is not a decimal digit
+_BCD_TABLE = tuple((b >> 4) * 10 + (b & 0x0F) if (b >> 4) < 10 and (b & 0x0F) < 10 else None for b in range(256))
+
 class Decoder(object):
 	def __init__(self):
 		pass
 
+	@staticmethod
+	def decode_NONE(data_ba):
+		return None
+
 	@staticmethod
 	def decode_INT8(data_ba):
-		return int.from_bytes(data_ba, byteorder='little', signed=False)
+		return _INT8.unpack(data_ba)[0]
 		
 	@staticmethod
 	def decode_INT16(data_ba):
-		return int.from_bytes(data_ba, byteorder='little', signed=False)
+		return _INT16.unpack(data_ba)[0]
 	
 	@staticmethod
 	def decode_INT24(data_ba):
-		return int.from_bytes(data_ba, byteorder='little', signed=False)
+		low, high = _INT24.unpack(data_ba)
+		return (high << 16) | low
 	
 	@staticmethod
 	def decode_INT32(data_ba):
-		return int.from_bytes(data_ba, byteorder='little', signed=False)
+		return _INT32.unpack(data_ba)[0]
 	
 	@staticmethod
 	def decode_FLOAT32(data_ba):
-		raise NotImplementedError('decode_FLOAT32')
+		return _FLOAT32.unpack(data_ba)[0]
 	
 	@staticmethod
-	def decode_INT48(self, data_ba):
-		raise NotImplementedError('decode_INT48')
+	def decode_INT48(data_ba):
+		low, high = _INT48.unpack(data_ba)
+		return (high << 32) | low
 	
 	@staticmethod
 	def decode_INT64(data_ba):
-		raise NotImplementedError('decode_INT64')
+		return _INT64.unpack(data_ba)[0]
+		
+	@staticmethod
+	def decode_INT(data_ba):
+		# binary numbers of any length (LVAR coded)
+		return int.from_bytes(data_ba, byteorder='little', signed=True)
 	
 	@staticmethod
 	def decode_BCD(data_ba):
-		result = ''
-		for x in reversed(data_ba):
-			result += str(int((x >> 4) & 0x0F)) + str(int(x) & 0x0F)
-		return result
+		'''
+		Type A, BCD coded integer. A high nibble 0xF in the most significant byte means a negative value,
+		any other nibble above 9 makes the value invalid (None)
+		'''
+		negative = (data_ba[-1] & 0xF0) == 0xF0
+		result = _BCD_TABLE[data_ba[-1] & 0x0F] if negative else _BCD_TABLE[data_ba[-1]]
+		if result is None: return None
+		for x in reversed(data_ba[:-1]):
+			digits = _BCD_TABLE[x]
+			if digits is None: return None
+			result = result * 100 + digits
+		return -result if negative else result
+		
+	@staticmethod
+	def decode_BCD_negative(data_ba):
+		# LVAR coded negative BCD
+		value = Decoder.decode_BCD(data_ba)
+		return None if value is None else -value
+		
+	@staticmethod
+	def decode_BCD_string(data_ba):
+		# BCD as a string of digits, keeps the leading zeros of identification numbers
+		return bytes(reversed(data_ba)).hex()
 	
 	@staticmethod
 	def decode_type_F(data_ba):
@@ -159,7 +244,8 @@ class Decoder(object):
 	
 	@staticmethod
 	def decode_STRING(data_ba):
-		return data_ba.decode('ascii')
+		# ASCII strings are transferred last character first
+		return bytes(reversed(data_ba)).decode('ascii', errors='replace')
 
 	@staticmethod
 	def decode_MBUSID(data_ba):
@@ -168,7 +254,7 @@ class Decoder(object):
 		'''
 		# gaat ervan uit dat data_ba een bytearray is......
 		results = {}
-		results['identification'] = Decoder.decode_BCD(data_ba[:4])
+		results['identification'] = Decoder.decode_BCD_string(data_ba[:4])
 		
 		manuf = int.from_bytes(data_ba[4:6],'little')
 		letter1 = chr(((manuf >> 10) & 0x001F) + 64)
@@ -187,13 +273,29 @@ class Decoder(object):
 		results['access_number'] = int(data_ba[8])
 	
 		results['status'] = Status_field(data_ba[9] & 0x03).name
+		results['status_flags'] = [name for bit, name in Status_flags.items() if data_ba[9] & bit]
 		results['signature_hex'] = ' '.join(format(x, '02x') for x in data_ba[10:12])
 		
 		return results
+		
+	@staticmethod
+	def lvar(lvar):
+		'''
+		Length and decoder of a variable length data field (DIF data coding 0b1101) from its LVAR byte
+		'''
+		if lvar <= 0xBF: return lvar, Decoder.decode_STRING
+		if 0xC0 <= lvar <= 0xCF: return lvar - 0xC0, Decoder.decode_BCD
+		if 0xD0 <= lvar <= 0xDF: return lvar - 0xD0, Decoder.decode_BCD_negative
+		if 0xE0 <= lvar <= 0xEF: return lvar - 0xE0, Decoder.decode_INT
+		if 0xF0 <= lvar <= 0xF4: return 4 * (lvar - 0xEC), Decoder.decode_INT
+		if lvar == 0xF5: return 48, Decoder.decode_INT
+		if lvar == 0xF6: return 64, Decoder.decode_INT
+		raise NotImplementedError(f'LVAR = {format(lvar, "02x")}')
 	
 
+# Decoder registry per DIF data coding, data codings 0b1101 (LVAR) and 0b1111 (special functions) are handled by the parser
 Data_field = {
-				0b0000:{'length':0, 'decoder':None},
+				0b0000:{'length':0, 'decoder':Decoder.decode_NONE},
 				0b0001:{'length':1, 'decoder':Decoder.decode_INT8},
 				0b0010:{'length':2, 'decoder':Decoder.decode_INT16},
 				0b0011:{'length':3, 'decoder':Decoder.decode_INT24},
@@ -202,14 +304,14 @@ Data_field = {
 				0b0110:{'length':6, 'decoder':Decoder.decode_INT48},
 				0b0111:{'length':8, 'decoder':Decoder.decode_INT64},
 				
-				0b1000:{'length':0, 'decoder':None},
+				0b1000:{'length':0, 'decoder':Decoder.decode_NONE},
 				0b1001:{'length':1, 'decoder':Decoder.decode_BCD},
 				0b1010:{'length':2, 'decoder':Decoder.decode_BCD},
 				0b1011:{'length':3, 'decoder':Decoder.decode_BCD},
 				0b1100:{'length':4, 'decoder':Decoder.decode_BCD},
-				0b1101:{'length':4, 'decoder':None},
+				0b1101:{'length':None, 'decoder':None},
 				0b1110:{'length':6, 'decoder':Decoder.decode_BCD},
-				0b1111:{'length':8, 'decoder':None}
+				0b1111:{'length':0, 'decoder':None}
 				}
 	
 # The VIF field contains all data specifications...
@@ -336,6 +438,14 @@ class MbusState(Enum):
 	Receiving=2
 	Retrying=3
 	
+class Priority(Enum):
+	'''
+	Priority of a bus transaction, waiting transactions with a lower value are served first
+	'''
+	High = 0
+	Normal = 1
+	Low = 2
+	
 
 class ConnectionType(Enum):
 	TCP = 1
@@ -343,26 +453,281 @@ class ConnectionType(Enum):
 	SERIAL = 3
 	
 	
+class BreakerState(Enum):
+	Closed = 0
+	Open = 1
+	HalfOpen = 2
+	
 tcp_buffersize = 1024
 
+class ResponseCache(object):
+	'''
+	Keeps the last parsed readout per gateway and slave address for a limited time (ttl), so consumers 
+	that ask for the same slave within seconds are answered without a bus transaction. 
+	Concurrent requests for a slave that is not cached are coalesced into one transaction (single-flight).
+	One cache can be shared by several masters, entries are keyed on the gateway as well.
+	
+	usage: cache = ResponseCache([ttl, maxsize, ttls])
+	
+	kwargs:
+	ttl: Default time to live of an entry in seconds (float:10.0)
+	maxsize: Maximum number of entries, the least recently used entry is dropped first (int:1024)
+	ttls: Time to live per meter, keyed on (gateway, slave_address) (dict:{})
+	'''
+	def __init__(self, **kwargs):
+		self.ttl = kwargs.pop('ttl', 10.0)
+		self.maxsize = kwargs.pop('maxsize', 1024)
+		self.ttls = dict(kwargs.pop('ttls', {}))
+		
+		self.hits = 0
+		self.misses = 0
+		self.coalesced = 0
+		
+		self._lock = threading.Lock()
+		self._entries = OrderedDict()					# key: (expires, results)
+		self._inflight = dict()							# key: [threading.Event, results, exception]
+		
+	def set_ttl(self, gateway, slave_address, ttl):
+		self.ttls[(gateway, slave_address)] = ttl
+		
+	def invalidate(self, gateway=None, slave_address=None):
+		'''
+		Removes all entries of a gateway and/or slave address, without arguments the cache is emptied
+		'''
+		with self._lock:
+			for key in list(self._entries):
+				if gateway is not None and key[0] != gateway: continue
+				if slave_address is not None and key[1] != slave_address: continue
+				del self._entries[key]
+		
+	def get(self, key, fetch, **kwargs):
+		'''
+		Returns a copy of the cached results for key (gateway, slave_address, options...), calls fetch() when 
+		there is no valid entry. When another thread is already fetching the same key, its result is awaited and shared.
+		Results of None (failed readouts) and exceptions are passed on to all waiting threads, but are not cached.
+		
+		kwargs:
+		coalesce: Wait for a fetch of another thread, False when that thread may be waiting for the caller (bool:True)
+		wait: Maximum time in seconds to wait for the fetch of another thread before fetching itself (float:None, no limit)
+		'''
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry and entry[0] > time.monotonic():
+				self._entries.move_to_end(key)
+				self.hits += 1
+				return self._copy(entry[1])
+			flight = self._inflight.get(key)
+			if flight and not kwargs.get('coalesce', True):
+				# fetch without taking part in the flight of the other thread
+				self.misses += 1
+				return self._copy(fetch())
+			if flight:
+				self.coalesced += 1
+				leader = False
+			else:
+				self.misses += 1
+				flight = self._inflight[key] = [threading.Event(), None, None]
+				leader = True
+				
+		if not leader:
+			if not flight[0].wait(kwargs.get('wait', None)):
+				_logger.debug(f'Fetch of {key} by another thread takes too long, fetching it again')
+				return self._copy(fetch())
+			if flight[2]: raise flight[2]
+			return self._copy(flight[1])
+			
+		try:
+			flight[1] = fetch()
+			if flight[1] is not None:
+				with self._lock:
+					self._entries[key] = (time.monotonic() + self.ttls.get(key[:2], self.ttl), flight[1])
+					self._entries.move_to_end(key)
+					while len(self._entries) > self.maxsize: self._entries.popitem(last=False)
+			return self._copy(flight[1])
+		except Exception as err:
+			flight[2] = err
+			raise
+		finally:
+			with self._lock: del self._inflight[key]
+			flight[0].set()
+			
+	@staticmethod
+	def _copy(results):
+		# callers get their own dicts, so changing a result does not change the cache
+		if results is None: return None
+		results = dict(results)
+		if 'fields' in results: results['fields'] = [dict(field) for field in results['fields']]
+		return results
+
+class SlaveHealth(object):
+	'''
+	Health registry with a circuit breaker per gateway and slave address. 
+	After failure_threshold failed readouts in a row the breaker of a slave opens and the slave is skipped, after the 
+	backoff time one probe readout is let through (half open). A failing probe doubles the backoff (up to max_backoff), 
+	a successful readout closes the breaker again. Open_until is a wall clock time, so the state can be saved and loaded.
+	One registry can be shared by several masters.
+	
+	usage: health = SlaveHealth([failure_threshold, backoff, max_backoff])
+	
+	kwargs:
+	failure_threshold: Number of failed readouts in a row that opens the breaker (int:3)
+	backoff: Time in seconds before the first probe of an open breaker (float:60.0)
+	max_backoff: Maximum time in seconds between probes (float:3600.0)
+	'''
+	def __init__(self, **kwargs):
+		self.failure_threshold = kwargs.pop('failure_threshold', 3)
+		self.backoff = kwargs.pop('backoff', 60.0)
+		self.max_backoff = kwargs.pop('max_backoff', 3600.0)
+		
+		self._lock = threading.Lock()
+		self._slaves = dict()								# (gateway, slave_address): dict with the health of that slave
+		
+	def _get(self, gateway, slave_address):
+		return self._slaves.setdefault((gateway, slave_address), dict(state=BreakerState.Closed, consecutive_failures=0, failures=0, 
+									successes=0, trips=0, open_until=0.0, probing=False, last_error='', last_success=None))
+		
+	def is_available(self, gateway, slave_address):
+		'''
+		True when a readout of this slave would be let through, does not change the state of the breaker
+		'''
+		with self._lock:
+			health = self._slaves.get((gateway, slave_address))
+			if health is None or health['state'] == BreakerState.Closed: return True
+			return not health['probing'] and time.time() >= health['open_until']
+		
+	def allow(self, gateway, slave_address):
+		'''
+		True when a readout of this slave may be done now. When the backoff of an open breaker has passed, 
+		the breaker goes half open and only this caller gets to probe the slave.
+		'''
+		with self._lock:
+			health = self._get(gateway, slave_address)
+			if health['state'] == BreakerState.Closed: return True
+			if health['probing'] or time.time() < health['open_until']: return False
+			health['state'] = BreakerState.HalfOpen
+			health['probing'] = True
+			return True
+			
+	def record_success(self, gateway, slave_address):
+		with self._lock:
+			health = self._get(gateway, slave_address)
+			if health['state'] != BreakerState.Closed: _logger.info(f'Slave {gateway}/{format(slave_address, "02x")} is responding again')
+			health.update(state=BreakerState.Closed, consecutive_failures=0, trips=0, open_until=0.0, probing=False, last_success=time.time())
+			health['successes'] += 1
+			
+	def record_failure(self, gateway, slave_address, error=''):
+		with self._lock:
+			health = self._get(gateway, slave_address)
+			health['failures'] += 1
+			health['consecutive_failures'] += 1
+			health['last_error'] = str(error)
+			health['probing'] = False
+			if health['state'] == BreakerState.HalfOpen or health['consecutive_failures'] >= self.failure_threshold:
+				backoff = min(self.max_backoff, self.backoff * 2 ** health['trips'])
+				health['trips'] += 1
+				health['state'] = BreakerState.Open
+				health['open_until'] = time.time() + backoff
+				_logger.warning(f'Slave {gateway}/{format(slave_address, "02x")} failed {health["consecutive_failures"]} times, skipped for {backoff} seconds')
+				
+	def metrics(self):
+		'''
+		returns: A list with the health of every known slave, failing slaves have failing=True
+		'''
+		with self._lock:
+			return [dict(health, gateway=gateway, address=slave_address, state=health['state'].name, failing=health['state'] != BreakerState.Closed) 
+					for (gateway, slave_address), health in self._slaves.items()]
+					
+	def to_dict(self):
+		return {'slaves': [{k:v for k,v in health.items() if k not in ['probing', 'failing']} for health in self.metrics()]}
+		
+	def from_dict(self, state):
+		with self._lock:
+			for health in state.get('slaves', []):
+				health = dict(health)
+				key = (health.pop('gateway'), health.pop('address'))
+				health['state'] = BreakerState[health['state']]
+				if health['state'] == BreakerState.HalfOpen: health['state'] = BreakerState.Open
+				health['probing'] = False
+				self._slaves[key] = dict(self._get(*key), **health)
+
 class MbusSpecific(object):
 	def __init__(self, **kwargs):
+		# Optional args with their defaults
+		self.cache = kwargs.pop('cache', None)
+		self.health = kwargs.pop('health', None)
 		
-		pass
+		# Add non arg properties and their defaults
+		# selection templates (DIF/VIF with the data coding set to 'selection for readout') per descr, learned per slave
+		self.record_templates = dict()
+		# per slave: True when the slave honours a record selection, False when it ignores it
+		self.selection_supported = dict()
+		# per slave: the frame count bit (FCB) of the next request, absent until the link to the slave is reset with a SND_NKE
+		self.fcb = dict()
+		# per slave: True when its last telegram announced more records to follow (or it is not known)
+		self.telegram_pending = dict()
+		# per slave: highest storage number and timestamp returned by get_storage_history
+		self.history_marks = dict()
+		
+	def _make_req_ud2(self, slave_address=0x01, fcb=False):
+		c = 0x7B if fcb else 0x5B
+		return bytearray([0x10, c, slave_address, self._calc_crc([c, slave_address]), 0x16])
+		
+	def _make_req_ud1(self, slave_address=0x01, fcb=False):
+		c = 0x7A if fcb else 0x5A
+		return bytearray([0x10, c, slave_address, self._calc_crc([c, slave_address]), 0x16])
+		
+	def _make_snd_ud(self, slave_address, ci, data, fcb=False):
+		c = 0x73 if fcb else 0x53
+		body = [c, slave_address, ci] + list(data)
+		return bytearray([0x68, len(body), len(body), 0x68] + body + [self._calc_crc(body), 0x16])
+		
+	def _make_snd_nke(self, slave_address=0x01):
+		return bytearray([0x10, 0x40, slave_address, self._calc_crc([0x40, slave_address]), 0x16])
+		
+	def _reset_link(self, slave_address, **kwargs):
+		'''
+		SND_NKE, after its acknowledge the slave treats the next request (FCB 1) as a new one
+		'''
+		answer = self.transact(self._make_snd_nke(slave_address), budget=kwargs.get('budget', None), retries=kwargs.get('retries', None))
+		if answer['c'] != 0xE5: raise MbusFramingError(f'Address {format(slave_address, "02x")} did not acknowledge SND_NKE')
+		self.fcb[slave_address] = True
+		self.telegram_pending[slave_address] = False
 		
-	def _make_req_ud2(self, slave_address=0x01):
-		return bytearray([0x10, 0x5B, slave_address, self._calc_crc([0x5B, slave_address]), 0x16])
+	def _start_run(self, slave_address):
+		# a run of requests that page through the telegrams of a slave starts with a reset of the link
+		self.fcb.pop(slave_address, None)
 		
-	def _make_req_ud1(self, slave_address=0x01):
-		return bytearray([0x10, 0x5A, slave_address, self._calc_crc([0x5A, slave_address]), 0x16])
+	def _fcb_transact(self, slave_address, make_request, **kwargs):
+		'''
+		Sends a request with the frame count bit of the slave, picked while holding the bus so concurrent callers
+		cannot reorder it. Every request toggles the FCB, so the slave sends a new telegram instead of repeating the last one.
+		The FCB is only toggled after a valid response, after a failed transaction it is unknown whether the slave saw the
+		request, so the link is reset before the next one.
+		The link is reset (SND_NKE) at the first contact with a slave, and before a request outside a paging run 
+		when the slave is halfway its telegrams, so that request gets the first telegram again.
+		'''
+		with self.transaction(kwargs.get('priority', Priority.Normal)):
+			if slave_address not in self.fcb or (not kwargs.get('paging', False) and self.telegram_pending.get(slave_address, False)):
+				self._reset_link(slave_address, **kwargs)
+			fcb = self.fcb[slave_address]
+			try:
+				answer = self.transact(make_request(slave_address, fcb), budget=kwargs.get('budget', None), retries=kwargs.get('retries', None))
+			except Exception:
+				self.fcb.pop(slave_address, None)
+				raise
+			self.fcb[slave_address] = not fcb
+			return answer
 
 	def scan_slaves_primary(self, **kwargs):
 		""" 
 		usage: slaves = test.scan_slaves_primary([scan_timeout, stop_at])
 		
 		kwargs:
-		scan_timeout: How long to wait for response from an address (float:1.0)
+		scan_timeout: Maximum time to spend on an address: the SND_NKE probe and, when a slave acknowledges it, the readout of its header.
+		An empty address only costs the response timeout that follows from the baudrate (float:1.0)
 		stop_at: Quit looking for more slaves after this number of detected slaves (int:250)
+		priority: Priority of the scan transactions on a shared bus (Priority:Priority.Low)
+		retries: Number of SND_NKE probes per address, the header readout of a slave that answered is repeated up to maxretries times (int:1)
 		
 		returns:
 		A dictionary with Fixed Data Headers (FDH's) part of the response of the detected slaves, keyed on their primary addresses.
@@ -370,19 +735,33 @@ class MbusSpecific(object):
 		"""
 		try:
 			if not self.is_connected(): raise Exception('Not connected')
-			self.TCPclientSock.settimeout(kwargs.get('scan_timeout', 1.0))
 				
 			scan_results = dict()
 			for addr in range(0,251,1):
 				try:
-					results = self._ud2_rsupd(addr, header_only=True)
+					priority = kwargs.get('priority', Priority.Low)
+					deadline = time.monotonic() + kwargs.get('scan_timeout', 1.0)
+					with self.transaction(priority):
+						# the SND_NKE is the probe, and resets the link of a slave that answers
+						try:
+							self._reset_link(addr, priority=priority, budget=kwargs.get('scan_timeout', 1.0), retries=kwargs.get('retries', 1))
+						except MbusTimeoutError as err:
+							# an empty address keeps the default response window for the next scan
+							self.response_delay.pop(addr, None)
+							_logger.debug(f'No slave detected on address {format(addr, "02x")}, err:{err}')
+							continue
+						# the address is occupied, the header readout gets the rest of the scan_timeout (with widening response windows)
+						results = self._ud2_rsupd(addr, header_only=True, priority=priority, budget=max(0.0, deadline - time.monotonic()), 
+												  retries=max(kwargs.get('retries', 1), self.maxretries))
 					scan_results[addr]=results
 					_logger.info(f'Found device on address {format(addr, "02x")}, ID:{results["identification"]}, manuf:{results["manufacturer"]}, version:{results["version"]}, medium:{results["medium"]}')
 					if len(scan_results) >= kwargs.get('stop_at', 250): return scan_results
-				except socket.timeout as err:
-					_logger.debug(f'No slave detected on address {format(addr, "02x")}, err:{err}')
+				except MbusTimeoutError as err:
+					_logger.warning(f'Slave on address {format(addr, "02x")} acknowledged the probe, but did not send its data in time, err:{err}')
+				except MbusError as err:
+					# more than one slave on this address or a noisy bus, the rest of the scan is still useful
+					_logger.warning(f'Invalid response on address {format(addr, "02x")}, err:{err}')
 			return scan_results
-			self.TCPclientSock.settimeout(self.timeout)
 		except Exception as err:
 			_logger.exception(err)
 			
@@ -396,6 +775,10 @@ class MbusSpecific(object):
 		kwargs:
 		extensive_mode: generate extra field information in the 'fields' part of the result (bool:False)
 		scale_results: Return scaled values (bool:True)
+		priority: Priority of this readout on a shared bus (Priority:Priority.Normal)
+		budget: Maximum time in seconds for this readout (float:timeout)
+		retries: Number of attempts when the response times out or is corrupt (int:maxretries)
+		use_cache: Answer from the response cache (if the master has one) when possible (bool:True)
 		
 		returns:
 		All fields/registers from 1 specific slave address. (only VARIABLE DATA STRUCTURE is supported at this moment)
@@ -404,23 +787,391 @@ class MbusSpecific(object):
 		'''
 		try:
 			if not self.is_connected(): raise Exception('Not connected')
-			return self._ud2_rsupd(slave_address, **kwargs)
+			fetch = lambda: self._guarded(slave_address, self._ud2_rsupd, **kwargs)
+			if self.cache is not None and kwargs.pop('use_cache', True):
+				options = tuple(bool(kwargs.get(x, default)) for x, default in [('extensive_mode', False), ('scale_results', True), ('header_only', False)])
+				# a thread that holds the bus must not wait for another thread that waits for the bus
+				return self.cache.get((self.gateway_id(), slave_address) + options, fetch, coalesce=self._bus_owner != threading.get_ident(), 
+									  wait=kwargs.get('budget', self.timeout))
+			return fetch()
 			
 		except Exception as err:
 			_logger.exception(err)
 			
 
+	def check_alarms(self, slave_address, **kwargs):
+		'''
+		usage: result = test.check_alarms(slave_address, [priority, extensive_mode, scale_results])
+		args:
+		slave_address: slave address to send request to (int:1)
+		
+		kwargs:
+		priority: Priority of the alarm request on a shared bus (Priority:Priority.High)
+		other kwargs as get_all_fields
+		
+		returns:
+		None when the slave has nothing to report: it acknowledged the REQ_UD1 (class 1 data request) with E5, or answered
+		without the ACD bit (access demand) and without an error status in its FDH.
+		Otherwise the response is returned as a full readout (as get_all_fields), a REQ_UD2 follows only when
+		the response is not a variable data structure. Its result gets an 'alarm' key with: class1_data (bool), status and status_flags of the class 1 response.
+		'''
+		try:
+			if not self.is_connected(): raise Exception('Not connected')
+			return self._guarded(slave_address, self._alarm_readout, **dict(kwargs, priority=kwargs.get('priority', Priority.High))) or None
+		except Exception as err:
+			_logger.exception(err)
+			
+	def _alarm_readout(self, slave_address, **kwargs):
+		with self.transaction(kwargs['priority']):
+			answer = self._fcb_transact(slave_address, self._make_req_ud1, **kwargs)
+			if answer['c'] == 0xE5: return dict()					# nothing to report (an empty result is not a failure for the circuit breaker)
+			
+			# the ACD bit (access demand) of the response flags class 1 data, many slaves answer a REQ_UD1 with their normal RSP_UD
+			alarm = dict(class1_data=bool(answer['c'] & 0x20))
+			if answer['ci'] in [0x72, 0x76] and len(answer['data']) >= 12:
+				header = Decoder.decode_MBUSID(answer['data'][:12])
+				alarm.update(status=header['status'], status_flags=header['status_flags'])
+			if not alarm['class1_data'] and alarm.get('status', 'No_error') == 'No_error' and not alarm.get('status_flags'): return dict()
+			
+			if answer['ci'] in [0x72, 0x76]:
+				# the answer already is a full readout
+				results = self._rsp_ud(slave_address, answer, **kwargs)
+			else:
+				results = self._ud2_rsupd(slave_address, **kwargs)
+		if results is None: return None
+		if self.cache is not None: self.cache.invalidate(self.gateway_id(), slave_address)
+		results['alarm'] = alarm
+		return results
+		
+	def poll_alarms(self, addresses, **kwargs):
+		'''
+		usage: results = test.poll_alarms(addresses, [priority, extensive_mode, scale_results])
+		
+		returns:
+		A dictionary keyed on slave address with the result of check_alarms for the slaves that had something to report
+		'''
+		results = dict()
+		for slave_address in addresses:
+			if self.health is not None and not self.health.is_available(self.gateway_id(), slave_address): continue
+			alarm_results = self.check_alarms(slave_address, **kwargs)
+			if alarm_results: results[slave_address] = alarm_results
+		return results
+		
+	def _guarded(self, slave_address, readout, **kwargs):
+		'''
+		Runs readout(slave_address, **kwargs) when the circuit breaker of the slave allows it and records the outcome,
+		returns None without a bus transaction when the breaker is open
+		'''
+		if self.health is None: return readout(slave_address, **kwargs)
+		gateway = self.gateway_id()
+		if not self.health.allow(gateway, slave_address):
+			_logger.debug(f'Skipped slave {format(slave_address, "02x")}, circuit breaker is open')
+			return None
+		try:
+			results = readout(slave_address, **kwargs)
+		except Exception as err:
+			self.health.record_failure(gateway, slave_address, err)
+			raise
+		if results is None:
+			self.health.record_failure(gateway, slave_address, 'No valid response')
+		else:
+			self.health.record_success(gateway, slave_address)
+		return results
+		
+	def get_selected_fields(self, slave_address, descrs, **kwargs):
+		'''
+		usage: result = test.get_selected_fields(slave_address, descrs, [extensive_mode, scale_results])
+		args:
+		slave_address: slave address to send request to (int:1)
+		descrs: The descr's of the wanted fields, as returned by get_all_fields (list:['Act_Volume 0:0'])
+		
+		kwargs: as get_all_fields
+		
+		returns:
+		The same structure as get_all_fields, but with only the wanted fields.
+		A SND_UD with a data record selection (CI 0x51) is sent before the REQ_UD2, so the slave only transfers the wanted records.
+		The records a slave supports are learned with a full readout the first time, slaves that ignore the 
+		selection are remembered and read out in full (the unwanted fields are left out of the result).
+		'''
+		try:
+			if not self.is_connected(): raise Exception('Not connected')
+			return self._guarded(slave_address, self._selected_readout, descrs=descrs, **kwargs)
+		except Exception as err:
+			_logger.exception(err)
+			
+	def _selected_readout(self, slave_address, descrs, **kwargs):
+		wanted = set(descrs)
+		templates = self.record_templates.get(slave_address, dict())
+		selection_failed = False
+		results = None
+		with self.transaction(kwargs.get('priority', Priority.Normal)):
+			if self.selection_supported.get(slave_address, True) and wanted.issubset(templates):
+				selection = b''.join(templates[descr] for descr in descrs)
+				if len(selection) <= 252:
+					results = self._selected_rsupd(slave_address, selection, **kwargs)
+					if results is not None:
+						returned = set(field['descr'] for field in results['fields'])
+						if returned and returned.issubset(wanted):
+							self.selection_supported[slave_address] = True
+							return self._strip_results(results, **kwargs)
+						# the slave acknowledged the selection but sent all its records, that response is the full readout
+						if not returned: results = None
+					selection_failed = True
+					
+			if results is None:
+				results = self._ud2_rsupd(slave_address, **dict(kwargs, extensive_mode=True))
+		if results is None: return None
+		if selection_failed:
+			# the slave responds, but does not handle the selection
+			_logger.info(f'Slave {format(slave_address, "02x")} ignores data record selection, using full readouts')
+			self.selection_supported[slave_address] = False
+		results['fields'] = [field for field in results['fields'] if field['descr'] in wanted]
+		return self._strip_results(results, **kwargs)
+			
+	def _selected_rsupd(self, slave_address, selection, **kwargs):
+		'''
+		SND_UD with the data record selection, followed by a REQ_UD2. Returns None when the slave does not acknowledge the selection.
+		'''
+		self._start_run(slave_address)
+		if not self._send_selection(slave_address, selection, **dict(kwargs, paging=True)): return None
+		return self._ud2_rsupd(slave_address, **dict(kwargs, extensive_mode=True, paging=True))
+		
+	def _send_selection(self, slave_address, selection, **kwargs):
+		'''
+		SND_UD with a data record selection, returns True when the slave acknowledged it
+		'''
+		try:
+			answer = self._fcb_transact(slave_address, lambda address, fcb: self._make_snd_ud(address, 0x51, selection, fcb), **kwargs)
+		except (MbusTimeoutError, MbusNakError):
+			answer = None
+		if answer is None or answer['c'] != 0xE5:
+			_logger.debug(f'Slave {format(slave_address, "02x")} did not acknowledge the data record selection')
+			return False
+		return True
+		
+	def get_storage_history(self, slave_address, **kwargs):
+		'''
+		usage: entries = test.get_storage_history(slave_address, [since, max_entries, relative_storage, max_telegrams, extensive_mode, scale_results])
+		args:
+		slave_address: slave address to send request to (int:1)
+		
+		kwargs:
+		since: Only return entries newer than this mark, a dict with 'storage', 'timestamp' and/or 'undated' (dict:the mark of the previous call)
+		max_entries: Number of storage numbers to select per call (int:12)
+		relative_storage: The slave numbers its storage relative to now, 1 = the most recent period as EN13757-3 meters do,
+		False for slaves that keep incrementing their storage numbers (bool:True)
+		max_telegrams: Maximum number of telegrams to read when the slave spreads its records over several telegrams (int:16)
+		other kwargs as get_all_fields
+		
+		returns:
+		A list of historical entries (storage number > 0) that were not returned before, oldest first. Every entry is a 
+		dictionary with 'storage', 'timestamp' (the value of the Time_point field of that storage number, if any) and 'fields'.
+		The newest storage number and timestamp are remembered in history_marks[slave_address]. For entries without a
+		timestamp in relative storage, the contents of the returned entries ('undated') are remembered, the number of
+		periods the slave moved on since the previous call follows from where those entries are found now.
+		
+		When the historical records of the slave are known (from an earlier extensive readout) and the slave supports 
+		record selection, only the storage numbers after the mark are requested. With relative storage numbers they are
+		selected from storage 1 back in growing chunks, until an entry that was returned before shows up. Otherwise all telegrams are read and 
+		the entries that were already returned are left out.
+		'''
+		try:
+			if not self.is_connected(): raise Exception('Not connected')
+			return self._guarded(slave_address, self._history_readout, **kwargs)
+		except Exception as err:
+			_logger.exception(err)
+			
+	def _history_readout(self, slave_address, **kwargs):
+		mark = kwargs.pop('since', None) or self.history_marks.get(slave_address, dict())
+		max_entries = kwargs.pop('max_entries', 12)
+		relative = kwargs.pop('relative_storage', True)
+		
+		fields = None
+		with self.transaction(kwargs.get('priority', Priority.Normal)):
+			types = self._history_templates(slave_address)
+			if types and self.selection_supported.get(slave_address, True):
+				if relative and (mark.get('timestamp') or mark.get('undated')):
+					fields = self._select_recent(slave_address, types, mark, max_entries, **kwargs)
+				else:
+					first = 1 if relative else mark.get('storage', 0) + 1
+					fields = self._select_storage(slave_address, types, range(first, first + max_entries), **kwargs)
+			if fields is None:
+				self._start_run(slave_address)
+				fields = self._read_telegrams(slave_address, **kwargs)
+		if fields is None: return None
+		
+		entries = self._group_entries(fields)
+		undated = sorted((x for x in entries.values() if not x['timestamp']), key=lambda x: x['storage'])
+		fingerprints = [self._entry_fingerprint(x) for x in undated]
+		if relative:
+			shift = self._storage_shift(mark.get('undated', []), fingerprints)
+			new_undated = set(x['storage'] for x in undated[:shift])
+			
+		new_entries = []
+		for entry in entries.values():
+			if entry['timestamp'] and mark.get('timestamp'):
+				if entry['timestamp'] <= mark['timestamp']: continue
+			elif relative:
+				if not entry['timestamp'] and entry['storage'] not in new_undated: continue
+			elif entry['storage'] <= mark.get('storage', 0):
+				continue
+			if not kwargs.get('extensive_mode', False):
+				entry['fields'] = [dict(descr=field['descr'], value=field['value'], unit=field['unit']) for field in entry['fields']]
+			new_entries.append(entry)
+		# oldest first: relative storage numbers count back from now
+		new_entries.sort(key=lambda x: -x['storage'] if relative else x['storage'])
+		
+		new_mark = dict(mark)
+		if relative and fingerprints: new_mark['undated'] = fingerprints
+		if new_entries:
+			if not relative: new_mark['storage'] = max(mark.get('storage', 0), max(x['storage'] for x in new_entries))
+			timestamps = [x['timestamp'] for x in new_entries if x['timestamp']]
+			if timestamps: new_mark['timestamp'] = max(timestamps + ([mark['timestamp']] if mark.get('timestamp') else []))
+		if new_mark != mark: self.history_marks[slave_address] = new_mark
+		return new_entries
+		
+	def _select_recent(self, slave_address, templates, mark, max_entries, **kwargs):
+		'''
+		Relative storage: selects storage 1, 2-3, 4-7, ... (at most max_entries) until an entry that was returned before 
+		(by its timestamp, or the contents of the newest undated entry of the mark) shows up
+		'''
+		fields = []
+		first, size = 1, 1
+		while first <= max_entries:
+			chunk = self._select_storage(slave_address, templates, range(first, min(first + size, max_entries + 1)), **kwargs)
+			if chunk is None: return None
+			fields += chunk
+			if any(self._returned_before(entry, mark) for entry in self._group_entries(chunk).values()): break
+			first += size
+			size *= 2
+		return fields
+		
+	def _returned_before(self, entry, mark):
+		if entry['timestamp']: return bool(mark.get('timestamp')) and entry['timestamp'] <= mark['timestamp']
+		return bool(mark.get('undated')) and self._entry_fingerprint(entry) == mark['undated'][0]
+		
+	@staticmethod
+	def _group_entries(fields):
+		# historical fields per storage number, with the value of the Time_point field of that storage number as timestamp
+		entries = dict()
+		for field in fields:
+			if field['storage'] == 0: continue
+			entry = entries.setdefault(field['storage'], dict(storage=field['storage'], timestamp=None, fields=[]))
+			if '_Time_point ' in field['descr']: entry['timestamp'] = field['value']
+			entry['fields'].append(field)
+		return entries
+		
+	@staticmethod
+	def _entry_fingerprint(entry):
+		# the contents of a historical entry without its storage number
+		return ';'.join(sorted(f"{field['descr'].rsplit(' ', 1)[0]}:{field['descr'].rsplit(':', 1)[-1]}={field['value']}" for field in entry['fields']))
+		
+	@staticmethod
+	def _storage_shift(previous, current):
+		'''
+		Number of periods a slave with relative storage numbers moved on: the smallest shift at which the entries
+		returned before (storage 1, 2, ...) line up with the current ones. All current entries are new when none does.
+		'''
+		for shift in range(len(current)):
+			overlap = list(zip(current[shift:], previous))
+			if overlap and all(now == before for now, before in overlap): return shift
+		return len(current)
+		
+	def _history_templates(self, slave_address):
+		'''
+		One selection template per type of historical record (descr without storage number, tariff), learned from extensive readouts
+		'''
+		types = dict()
+		for descr, template in self.record_templates.get(slave_address, dict()).items():
+			base, numbers = descr.rsplit(' ', 1)
+			storage_nr, tariff = numbers.split(':')
+			if int(storage_nr) > 0: types.setdefault((base, tariff), template)
+		return list(types.values())
+		
+	def _select_storage(self, slave_address, templates, storage_nrs, **kwargs):
+		'''
+		Selects the historical records of the given storage numbers and reads them, returns None when the slave does not handle the selection
+		'''
+		wanted = set(storage_nrs)
+		selections = [self._set_storage_nr(template, storage_nr) for storage_nr in storage_nrs for template in templates]
+		fields = []
+		while selections:
+			chunk = b''
+			while selections and len(chunk) + len(selections[0]) <= 252: chunk += selections.pop(0)
+			self._start_run(slave_address)
+			if not self._send_selection(slave_address, chunk, **dict(kwargs, paging=True)): return None
+			chunk_fields = self._read_telegrams(slave_address, **kwargs)
+			if chunk_fields is None: return None
+			if any(field['storage'] not in wanted for field in chunk_fields):
+				_logger.info(f'Slave {format(slave_address, "02x")} ignores data record selection, using full readouts')
+				self.selection_supported[slave_address] = False
+				return None
+			fields += chunk_fields
+		return fields
+		
+	def _read_telegrams(self, slave_address, **kwargs):
+		'''
+		Reads telegrams (REQ_UD2 with toggled FCB) until the slave has no more records to follow, returns all fields.
+		The caller starts the run (_start_run) before the first request of it.
+		'''
+		fields = []
+		for telegram in range(kwargs.get('max_telegrams', 16)):
+			results = self._ud2_rsupd(slave_address, **dict(kwargs, extensive_mode=True, paging=True))
+			if results is None: return None if telegram == 0 else fields
+			fields += results.get('fields', [])
+			if not results.get('more_records_follow', False): break
+		return fields
+		
+	@staticmethod
+	def _set_storage_nr(drh, storage_nr):
+		'''
+		Returns a copy of a data record header with another storage number, the LSB goes in the DIF, 
+		the next bits 4 at a time in the DIFE's (tariff and subunit bits of existing DIFE's are kept)
+		'''
+		index = 1
+		difes = []
+		while drh[index - 1] & 0x80:
+			difes.append(drh[index] & 0x70)
+			index += 1
+		while (storage_nr >> (1 + 4 * len(difes))) > 0: difes.append(0x00)
+		
+		dif = (drh[0] & 0x3F) | ((storage_nr & 0x01) << 6) | (0x80 if difes else 0x00)
+		result = bytearray([dif])
+		for nr, dife in enumerate(difes):
+			extension = 0x80 if nr < len(difes) - 1 else 0x00
+			result.append(extension | dife | ((storage_nr >> (1 + 4 * nr)) & 0x0F))
+		return bytes(result + drh[index:])
+		
+	def _learn_templates(self, slave_address, results):
+		templates = self.record_templates.setdefault(slave_address, dict())
+		for field in results['fields']:
+			drh = bytearray(field['DRH'])
+			drh[0] = (drh[0] & 0xF0) | 0x08					# data coding 'selection for readout'
+			templates.setdefault(field['descr'], bytes(drh))
+			
+	def _strip_results(self, results, **kwargs):
+		# results parsed in extensive mode, back to the form the caller asked for
+		if kwargs.get('extensive_mode', False): return results
+		results.pop('response', None)
+		results['fields'] = [dict(descr=field['descr'], value=field['value'], unit=field['unit']) for field in results['fields']]
+		return results
+		
 	def _ud2_rsupd(self, slave_address, **kwargs):
-		self.send(self._make_req_ud2(slave_address))
-		answer = self.recv()
+		answer = self._fcb_transact(slave_address, self._make_req_ud2, **kwargs)
+		return self._rsp_ud(slave_address, answer, **kwargs)
 		
+	def _rsp_ud(self, slave_address, answer, **kwargs):
 		# Control codes for Data Transfer from Slave to Master after Request: [0x08, 0x18, 0x28, 0x38]
 		if answer['c'] in [0x08, 0x18, 0x28, 0x38]:				# Normal RSP_UD Data Transfer from Slave to Master after Request
 			if answer['ci'] in [0x72, 0x76]:					# Variable Data Structure
 				results = self._parseVDS(answer['data'], **kwargs)
+				if results is None: return None
+				# a header only readout does not tell whether more telegrams follow
+				self.telegram_pending[slave_address] = kwargs.get('header_only', False) or results.get('more_records_follow', False)
+				if 'fields' in results and kwargs.get('extensive_mode', False): self._learn_templates(slave_address, results)
 				return results
 			if answer['ci'] in [0x70]:							# RSP_UD Application error response
-				raise NotImplementedError('RSP_UD Application error response')
+				raise MbusApplicationError(f'Application error response from address {format(slave_address, "02x")}: {" ".join(format(x, "02x") for x in answer["data"])}')
 
 
 
@@ -450,6 +1201,17 @@ class MbusSpecific(object):
 				Decode the next field from the data_ba byte array
 				'''
 				DR_start = index
+				if data_ba[index] == 0x2F:
+					# idle filler
+					index += 1
+					continue
+				if (data_ba[index] & 0x0F) == 0x0F:
+					# special function 0x0F/0x1F: manufacturer specific data up to the end of the telegram, 
+					# 0x1F tells that more records follow in the next telegram
+					results['more_records_follow'] = data_ba[index] == 0x1F
+					results['manufacturer_data'] = data_ba[index + 1:]
+					break
+					
 				dif_info, index = self._VDSdif_decoder(data_ba, index)
 				function, var_length, _, _, storage_nr, tariff = dif_info
 				
@@ -457,13 +1219,19 @@ class MbusSpecific(object):
 				descr, scaling, unit, nr_bytes, decoder = vif_info
 				
 				data_start = index
+				if var_length:
+					# the length (and coding) of the data is given by the first byte after the DRH
+					nr_bytes, lvar_decoder = Decoder.lvar(data_ba[index])
+					if decoder is None: decoder = lvar_decoder
+					index += 1
 				
 				value = decoder(data_ba[index:index + nr_bytes])
 				_logger.debug(f'decoded databytes on index {index} for {function}_{descr}_{storage_nr}, decoder: {decoder}, result: {value}')
 				index += nr_bytes
 				
+				numeric = isinstance(value, (int, float)) and not isinstance(value, bool)
 				field = dict(	descr=f'{function}_{descr} {storage_nr}:{tariff}', 
-								value=value*scaling if kwargs.get('scale_results', True) else value, 
+								value=value*scaling if numeric and kwargs.get('scale_results', True) else value, 
 								unit=unit)
 				if kwargs.get('extensive_mode', False): field.update(dict(	
 															function=function,
@@ -473,6 +1241,7 @@ class MbusSpecific(object):
 															scaling=scaling, 
 															DR_startindex=DR_start, 
 															DR=data_ba[DR_start:index], 
+															DRH=data_ba[DR_start:data_start], 
 															decoder=decoder)
 													)
 				results['fields'].append(field)
@@ -497,15 +1266,10 @@ class MbusSpecific(object):
 		
 		function = Function_field((dif >> 4) & 0x03).name
 		
-		if (dif & 0x0F) == 0b1101:
-			# In this case the length is given by the first databyte after the DRH (header), so the first real databyte (LVAR)
-			nr_bytes = None
-			decoder = None
-			var_length = True
-		else:
-			nr_bytes = Data_field[dif & 0x0F]['length']
-			decoder = Data_field[dif & 0x0F]['decoder']
-			var_length = False
+		# In case of 0b1101 the length is given by the first databyte after the DRH (header), so the first real databyte (LVAR)
+		var_length = (dif & 0x0F) == 0b1101
+		nr_bytes = Data_field[dif & 0x0F]['length']
+		decoder = Data_field[dif & 0x0F]['decoder']
 			
 		# So far storage nummer is 0 or 1 and tariff is 0 (default), via extended DIF fields more storage numbers and tariffs can be specified 
 		shift_store = 1
@@ -535,35 +1299,21 @@ class MbusSpecific(object):
 		index += 1
 		
 		if vif in [0x7E, 0xFE]:
-			raise NotImplementedError('vif in [0x7E, 0xFE]')
+			# any VIF, only used in selections
+			descr, scaling, unit = 'Any', 1, ''
+			index = self._skip_vifes(data_ba, vif, index)
 		elif vif in [0x7F, 0xFF]:
-			raise NotImplementedError('vif in [0x7F, 0xFF]')
+			# manufacturer specific VIF, the data is still coded according to the DIF
+			descr, scaling, unit = 'Manufacturer_specific', 1, ''
+			index = self._skip_vifes(data_ba, vif, index)
 		elif vif in [0x7C, 0xFC]:
-			# ASCII string, length is given in the first byte of the data (als0 DIF-var_length should be True)
-			if not var_length: raise ProtocolError(f'ASCII field, but var_length in DIF not True')
-			# no need to look for further VIFE's'
-			descr = ''
+			# plain text VIF, the description is given as an ASCII string (length in the first byte) after the VIF(E)'s
+			index = self._skip_vifes(data_ba, vif, index)
+			lvar = int(data_ba[index])
+			descr = Decoder.decode_STRING(data_ba[index + 1:index + 1 + lvar])
 			scaling = 1
 			unit = ''
-			lvar = int(data_ba[index])
-			index += 1
-			value_startindex = index
-			
-			if 0x00 <= lvar <= 0xBF:
-				decoder = decode_STRING
-				nr_bytes = int(lvar)
-			elif 0xC0 <= lvar <= 0xCF:
-				nr_bytes = int(lvar - 0xC0)
-				decoder = decode_BCD
-			elif 0xD0 <= lvar <= 0xDF:
-				nr_bytes = int(lvar - 0xD0)
-				decoder = lambda x: '-' + decode_BCD(x)
-			elif 0xE0 <= lvar <= 0xEF:
-				nr_bytes = int(lvar - 0xE0)
-				decoder = lambda x: int.from_bytes(x)
-			else:
-				raise NotImplementedError(f'LVAR = {format(lvar, "02x")}')
-				
+			index += 1 + lvar
 			
 		elif vif in [0xFD, 0xFB]:
 			# he true VIF is given by the next byte and the coding is taken from the table for secondary VIF (chapter 8.4.4). 
@@ -593,6 +1343,13 @@ class MbusSpecific(object):
 			
 		return (descr, scaling, unit, nr_bytes, decoder), index
 		
+	def _skip_vifes(self, data_ba, vif, index):
+		# skip VIFE's that are not interpreted
+		while vif > 0x7F:
+			vif = int(data_ba[index])
+			index += 1
+		return index
+		
 	def _get_value_information(self, table, vif, max_shift=3):
 		'''
 		Retrieved the data definition from a dictionary (table) based on a lookup key (vif) in bitwise string representation
@@ -646,14 +1403,140 @@ class BaseMbusMaster(MbusSpecific):
 		self.conn_type = kwargs.pop('conn_type', None)
 		self.timeout = kwargs.pop('timeout', 20)
 		self.maxretries = kwargs.pop('maxretries', 3)
+		self.baudrate = kwargs.pop('baudrate', 2400)
+		self.link_latency = kwargs.pop('link_latency', 0.1)
 		
 		# pass on the rest of the kwargs to the base classes
 		super().__init__(**kwargs)
 
 		# other properties and defaults
 		self.conn_state = ConnState.DisConnected
-		self.bus_state = MbusState.Idle
+		self.mbus_state = MbusState.Idle
 		self.buffersize = 4096
+		
+		# transaction serialization: one request/response pair on the bus at a time, waiting
+		# transactions are queued on (priority, arrival order)
+		self._bus_cond = threading.Condition()
+		self._bus_queue = []
+		self._bus_ticket = itertools.count()
+		self._bus_owner = None
+		self._bus_depth = 0
+		
+		# measured response delay (seconds) per slave address, used to derive the response timeouts
+		self.response_delay = dict()
+		# set when a transaction was cancelled halfway a telegram, the remainder has to be drained from the link
+		self._stale = False
+
+	def gateway_id(self):
+		'''
+		Identification of the gateway behind this master, used as key in shared caches and registries
+		'''
+		return f'{self.__class__.__name__}@{hex(id(self))}'
+
+	@property
+	def bus_state(self):
+		return self.mbus_state
+		
+	@bus_state.setter
+	def bus_state(self, state):
+		self.mbus_state = state
+
+	@contextmanager
+	def transaction(self, priority=Priority.Normal):
+		'''
+		usage: with test.transaction([priority]): ...
+		
+		Gives the calling thread exclusive use of the bus for the duration of the with block. Other threads 
+		wait in a queue ordered on priority (Priority.High first) and arrival time. 
+		The lock is re-entrant, so a thread that holds the bus can start nested transactions.
+		'''
+		me = threading.get_ident()
+		with self._bus_cond:
+			if self._bus_owner == me:
+				self._bus_depth += 1
+			else:
+				ticket = (priority.value, next(self._bus_ticket))
+				heapq.heappush(self._bus_queue, ticket)
+				try:
+					while self._bus_owner is not None or self._bus_queue[0] != ticket:
+						self._bus_cond.wait()
+				except BaseException:
+					# an interrupted waiter (KeyboardInterrupt, ...) must not block the queue behind its ticket
+					self._bus_queue.remove(ticket)
+					heapq.heapify(self._bus_queue)
+					self._bus_cond.notify_all()
+					raise
+				heapq.heappop(self._bus_queue)
+				self._bus_owner = me
+				self._bus_depth = 1
+		try:
+			yield self
+		finally:
+			with self._bus_cond:
+				self._bus_depth -= 1
+				if self._bus_depth == 0:
+					self._bus_owner = None
+					self._bus_cond.notify_all()
+
+	def transact(self, request, priority=Priority.Normal, budget=None, retries=None):
+		'''
+		Sends a request and reads the response as one uninterruptable transaction on the bus
+		
+		args:
+		request: The encoded request telegram
+		
+		kwargs:
+		priority: Priority of this transaction on a shared bus (Priority:Priority.Normal)
+		budget: Maximum time in seconds for the complete transaction, including the time spent waiting 
+		for the bus. The response timeouts are derived from the baudrate, the telegram lengths and the 
+		measured response delay of the slave, the budget only caps them (float:self.timeout)
+		retries: Number of attempts when the response times out or is corrupt (int:self.maxretries)
+		
+		A failed attempt is repeated with the very same request, so with the same FCB: a slave that did receive the 
+		request sends the same telegram again instead of the next one. Stale bytes are drained from the link before every repeat.
+		
+		returns: The decoded response telegram (see recv)
+		raises: MbusTimeoutError when the budget expires, the transaction is cancelled without leaving stale bytes on the bus.
+		MbusChecksumError, MbusFramingError or MbusNakError when the last attempt failed.
+		'''
+		deadline = time.monotonic() + (self.timeout if budget is None else budget)
+		slave_address = request[2] if request[0] == 0x10 else request[5]
+		attempts = max(1, self.maxretries if retries is None else retries)
+		with self.transaction(priority):
+			for attempt in range(attempts):
+				if time.monotonic() >= deadline:
+					raise MbusTimeoutError(f'Transaction for address {format(slave_address, "02x")} expired')
+				# a telegram that was cancelled halfway gets time to arrive, late responses are discarded without waiting
+				self._drain(self.link_latency if self._stale or attempt else 0.0)
+				self.send(request)
+				try:
+					answer = self.recv(deadline=deadline, slave_address=slave_address, request_length=len(request))
+					# late responses to the earlier attempts may still be underway
+					if attempt: self._stale = True
+					return answer
+				except retry_errors as err:
+					if attempt == attempts - 1 or time.monotonic() >= deadline: raise
+					_logger.warning(f'{err.__class__.__name__} on address {format(slave_address, "02x")}: {err}, repeating request (attempt {attempt + 2} of {attempts})')
+					self.mbus_state = MbusState.Retrying
+			
+	def _wire_time(self, nr_bytes):
+		'''
+		Time (seconds) needed to transfer nr_bytes over the bus, 11 bits per byte (start, 8 data, parity, stop)
+		'''
+		return nr_bytes * 11 / self.baudrate
+		
+	def _response_timeout(self, slave_address, request_length=5):
+		'''
+		Time to wait for the first byte of a response. EN13757-2 allows a slave 11 up to (330 bit times + 50 ms) 
+		to start its response, a slave that has been measured to respond slower gets twice its measured delay.
+		The window is capped at the time a bridge that buffers complete frames needs for a maximum length response.
+		'''
+		return self._wire_time(request_length) + self._response_delay_window(slave_address) + self.link_latency
+		
+	def _response_delay_window(self, slave_address):
+		max_delay = 330 / self.baudrate + 0.050
+		measured = self.response_delay.get(slave_address, 0.0)
+		return min(max(max_delay, 2 * measured), max_delay + self._wire_time(261))
 
 
 		
@@ -704,34 +1587,102 @@ class BaseMbusMaster(MbusSpecific):
 		"""
 		raise NotImplementedException("Method not implemented by derived class")
 
-	def recv(self, size=tcp_buffersize):
-		""" Reads data from the underlying subclass _recv routine
-		:param size: The buffer size or number of bytes to read
-		:return: The bytes read
+	def recv(self, deadline=None, slave_address=None, request_length=5):
+		""" Reads one complete telegram from the underlying subclass _recv routine
+		:param deadline: time.monotonic() value at which the transaction is cancelled
+		:param slave_address: The address the response is expected from, used for the response timeout
+		:param request_length: Length of the request that was sent, used for the response timeout
+		:return: The decoded telegram as a dictionary with l, c, ci, a and data
+		:raises: MbusTimeoutError, MbusChecksumError, MbusFramingError or MbusNakError, retries are done by transact
 		"""
-		data = None
-		# TODO: Dont know how to implement the maxretries mechanism on the receiver side......
+		if deadline is None: deadline = time.monotonic() + self.timeout
 		self.mbus_state = MbusState.Receiving
-		data = self._recv(size)
-		self.mbus_state = MbusState.Idle
+		data = bytearray()
+		try:
+			sent = time.monotonic()
+			data += self._read(1, min(deadline, sent + self._response_timeout(slave_address, request_length)))
+			if slave_address is not None:
+				# keep a moving average of the response delay of this slave
+				delay = max(0.0, time.monotonic() - sent - self._wire_time(request_length) - self.link_latency)
+				previous = self.response_delay.get(slave_address, delay)
+				self.response_delay[slave_address] = 0.75 * previous + 0.25 * delay
+				
+			# check if valid start of telegram (data[0] in [0x10, 0xE5, 0x68])
+			if data[0] == 0xE5:
+				# single character acknowledge
+				return {'l':0, 'c':0xE5, 'ci':None, 'a':slave_address, 'data':bytearray()}
+			elif data[0] == 0xA2:
+				raise MbusNakError(f'Negative acknowledge from address {slave_address}')
+			elif data[0] == 0x68:
+				data += self._read(3, min(deadline, time.monotonic() + self._wire_time(3) + self.link_latency))
+				# a long frame holds at least C, A and CI
+				if data[1] != data[2] or data[3] != 0x68 or data[1] < 3:
+					self._stale = True
+					raise MbusFramingError('length field error')
+				rest = data[1] + 2
+				data += self._read(rest, min(deadline, time.monotonic() + self._wire_time(rest) + self.link_latency))
+			else:
+				self._stale = True
+				raise MbusFramingError(f'Invalid start of telegram byte {format(data[0], "02x")}')
+		except socket.timeout as err:
+			# the rest of the telegram is still underway, clear it before the next transaction
+			self._stale = len(data) > 0
+			if not data and slave_address is not None:
+				# the slave may be behind a bridge that only forwards complete frames, double its window for the next attempt
+				self.response_delay[slave_address] = self._response_delay_window(slave_address)
+			if isinstance(err, MbusTimeoutError): raise
+			raise MbusTimeoutError(str(err)) from err
+		finally:
+			self.mbus_state = MbusState.Idle
 		
-		# check if valid start of telegram (data[0] in [0x10, 0xE5, 0x68])
-		if data[0] == 0x68:
-			l, c, a, ci = int(data[1]), data[4], data[5], data[6]
-			# check CRC
-			crc = self._calc_crc(data[4:-2])
-			if crc != data[-2]:
-				raise Exception('Checksum error')
-			if l != len(data[4:-2]):
-				raise Exception('length field error')
-			return {'l':l, 'c':c, 'ci':ci, 'a':a, 'data':data[7:-2]}
-		else:
-			raise Exception(f'Invalid start of telegram byte {format(data[0], "2x")}')
+		l, c, a, ci = int(data[1]), data[4], data[5], data[6]
+		# check CRC
+		crc = self._calc_crc(data[4:-2])
+		if crc != data[-2]:
+			raise MbusChecksumError(f'Checksum error, received {format(data[-2], "02x")}, calculated {format(crc, "02x")}')
+		if l != len(data[4:-2]):
+			raise MbusFramingError('length field error')
+		if data[-1] != 0x16:
+			raise MbusFramingError(f'Invalid stop byte {format(data[-1], "02x")}')
+		if slave_address not in [None, 0xFE, 0xFF] and a != slave_address:
+			raise MbusFramingError(f'Response from address {format(a, "02x")}, expected {format(slave_address, "02x")}')
+		return {'l':l, 'c':c, 'ci':ci, 'a':a, 'data':data[7:-2]}
+		
+	def _read(self, nr_bytes, until):
+		'''
+		Reads exactly nr_bytes from the underlying subclass _recv routine, raises a timeout when they 
+		have not arrived before until (time.monotonic() value)
+		'''
+		data = bytearray()
+		while len(data) < nr_bytes:
+			remaining = until - time.monotonic()
+			if remaining <= 0: raise MbusTimeoutError(f'Timeout, received {len(data)} of {nr_bytes} bytes')
+			chunk = self._recv(nr_bytes - len(data), timeout=remaining)
+			if not chunk: raise ConnectionError('Connection closed by remote host')
+			data += chunk
+		return data
+		
+	def _drain(self, wait=0.0):
+		'''
+		Discards everything that is still underway on the link (remainders of cancelled transactions)
+		wait: Time in seconds to wait for more bytes, 0.0 only discards what has already arrived
+		'''
+		drained = 0
+		try:
+			while True:
+				chunk = self._recv(self.buffersize, timeout=wait)
+				if not chunk: break
+				drained += len(chunk)
+		except (socket.timeout, BlockingIOError):
+			pass
+		if drained: _logger.debug(f'Drained {drained} stale bytes')
+		self._stale = False
 
-	def _recv(self, size):
+	def _recv(self, size, timeout=None):
 		""" Reads data from the underlying descriptor
 
-		:param size: The number of bytes to read
+		:param size: The maximum number of bytes to read
+		:param timeout: Maximum time to wait for data in seconds, None for the default timeout
 		:return: The bytes read
 		"""
 		raise NotImplementedException("Method not implemented by derived class")
@@ -834,40 +1785,45 @@ class MbusTcpMaster(BaseMbusMaster):
 		
 		if self.auto_connect: self.connect()
 		
+	def gateway_id(self):
+		return f'{self.host}:{self.port}'
+		
 	def connect(self):
 		if not self.conn_type == ConnectionType.TCP:
 			raise NotImplementedError(f'Connection type {self.conn_type} not implemented in {self}')
 			
-		self.conn_state = ConnState.Connecting
-		self.TCPclientSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.TCPclientSock.settimeout(self.timeout)
-		
-		for tries in range(self.maxretries):
-			try:
-				self.TCPclientSock.connect((self.host, self.port))
-				self.conn_state = ConnState.Connected
-				self.mbus_state = MbusState.Idle
-				_logger.info(f'{self}')
-				break
-			except Exception as err:
-				_logger.error (f'{self.name}-- Problem connecting {self.conn_type}-{self.host}:{self.port} attempt {tries+1}, {err}')
-				time.sleep(0.5)
-		if not self.is_connected(): 
-			_logger.error('disconnecting')
-			self.close()
-			return False
-		else:
-			_logger.info('Connected')
-			return True
+		with self.transaction(Priority.High):
+			self.conn_state = ConnState.Connecting
+			self.TCPclientSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.TCPclientSock.settimeout(self.timeout)
+			
+			for tries in range(self.maxretries):
+				try:
+					self.TCPclientSock.connect((self.host, self.port))
+					self.conn_state = ConnState.Connected
+					self.mbus_state = MbusState.Idle
+					_logger.info(f'{self}')
+					break
+				except Exception as err:
+					_logger.error (f'{self.name}-- Problem connecting {self.conn_type}-{self.host}:{self.port} attempt {tries+1}, {err}')
+					time.sleep(0.5)
+			if not self.is_connected(): 
+				_logger.error('disconnecting')
+				self.close()
+				return False
+			else:
+				_logger.info('Connected')
+				return True
 						
 	def close(self):
-		if self.is_connected(): 
-			_logger.debug('I am connected.... now disconnecting')
-			self.TCPclientSock.close()
-			
-		self.TCPclientSock = None
-		self.conn_state = ConnState.DisConnected
-		self.bus_state = MbusState.Idle
+		with self.transaction(Priority.High):
+			if self.is_connected(): 
+				_logger.debug('I am connected.... now disconnecting')
+				self.TCPclientSock.close()
+				
+			self.TCPclientSock = None
+			self.conn_state = ConnState.DisConnected
+			self.mbus_state = MbusState.Idle
 				
 						
 	def is_connected(self):
@@ -883,7 +1839,8 @@ class MbusTcpMaster(BaseMbusMaster):
 				# print (err)
 				return False
 			
-	def _recv(self, size):
+	def _recv(self, size, timeout=None):
+		self.TCPclientSock.settimeout(self.timeout if timeout is None else timeout)
 		data = self.TCPclientSock.recv(size)
 		return data
 		
@@ -896,17 +1853,312 @@ class MbusTcpMaster(BaseMbusMaster):
 		sndbytes = self.TCPclientSock.send(sndmsg)
 		return sndbytes
 
-		
+
+class MbusPoller(object):
+	"""
+	Polls a list of slaves on one master in a background thread and keeps the latest readout of every 
+	slave in memory. Listeners are called with (slave_address, results) after every successful readout.
+	
+	usage: poller = MbusPoller(master, addresses, [interval, alarm_interval, priority, name, state_file, **get_all_fields kwargs])
+	
+	With an alarm_interval the slaves are asked for class 1 data (REQ_UD1, see check_alarms) every alarm_interval seconds 
+	in between the full readouts. Slaves that report something are read out in full right away, their results 
+	(with an 'alarm' key) go to the listeners like any other readout.
 	
+	When the master has a SlaveHealth registry, slaves with an open circuit breaker are skipped. With a state_file the 
+	slave inventory (the FDH of every slave) and the circuit breaker states are saved after every cycle and loaded at start, 
+	so broken slaves stay backed off after a restart. An empty list of addresses is then taken from the saved inventory.
+	"""
+	def __init__(self, master, addresses, **kwargs):
+		# Mandatory args
+		self.master = master
+		self.addresses = list(addresses)
 		
+		# Optional args with their defaults
+		self.interval = kwargs.pop('interval', 60.0)
+		self.alarm_interval = kwargs.pop('alarm_interval', None)
+		self.priority = kwargs.pop('priority', Priority.Normal)
+		self.name = kwargs.pop('name', f'Poller {master.gateway_id()}')
+		self.state_file = kwargs.pop('state_file', None)
+		# the rest of the kwargs are passed on to get_all_fields
+		self.readout_kwargs = kwargs
+		
+		# Add non arg properties and their defaults
+		self.latest = dict()
+		self.listeners = []
+		self.cycles = 0
+		self.skipped = 0
+		self.inventory = dict()
+		self._stop_event = threading.Event()
+		self._thread = None
+		
+		if self.state_file: self.load_state()
+		
+	def __repr__(self):
+		return f"{self.name}: {len(self.addresses)} slaves, interval={self.interval}"
+		
+	def add_listener(self, listener):
+		self.listeners.append(listener)
+		
+	def start(self):
+		if self._thread and self._thread.is_alive(): return
+		self._stop_event.clear()
+		self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+		self._thread.start()
+		
+	def stop(self, timeout=None):
+		self._stop_event.set()
+		if self._thread: self._thread.join(timeout)
+		
+	def poll_once(self):
+		"""
+		Reads all slaves once, returns the number of successful readouts
+		"""
+		if not self.master.is_connected(): self.master.connect()
+		succeeded = 0
+		health = self.master.health
+		for slave_address in self.addresses:
+			if self._stop_event.is_set(): break
+			if health is not None and not health.is_available(self.master.gateway_id(), slave_address):
+				self.skipped += 1
+				continue
+			results = self.master.get_all_fields(slave_address, priority=self.priority, **self.readout_kwargs)
+			if not results: continue
+			self._publish(slave_address, results)
+			succeeded += 1
+		self.cycles += 1
+		if self.state_file: self.save_state()
+		return succeeded
+		
+	def poll_alarms_once(self):
+		'''
+		Asks all slaves once for class 1 data, returns the addresses of the slaves that reported something
+		'''
+		if not self.master.is_connected(): self.master.connect()
+		alarms = self.master.poll_alarms(self.addresses, **self.readout_kwargs)
+		for slave_address, results in alarms.items(): self._publish(slave_address, results)
+		return list(alarms)
+		
+	def _publish(self, slave_address, results):
+		results['timestamp'] = time.time()
+		self.latest[slave_address] = results
+		self.inventory[slave_address] = {k:v for k,v in results.items() if k not in ['fields', 'response', 'manufacturer_data', 'alarm']}
+		for listener in self.listeners:
+			try:
+				listener(slave_address, results)
+			except Exception as err:
+				_logger.exception(err)
+		
+	def save_state(self):
+		state = {'inventory': self.inventory}
+		if self.master.health is not None: state['health'] = self.master.health.to_dict()
+		try:
+			with open(self.state_file + '.tmp', 'w') as f: json.dump(state, f, default=str)
+			os.replace(self.state_file + '.tmp', self.state_file)
+		except Exception as err:
+			_logger.error(f'Problem saving state to {self.state_file}, {err}')
+			
+	def load_state(self):
+		try:
+			with open(self.state_file) as f: state = json.load(f)
+		except FileNotFoundError:
+			return
+		except Exception as err:
+			_logger.error(f'Problem loading state from {self.state_file}, {err}')
+			return
+		self.inventory = {int(addr):fdh for addr,fdh in state.get('inventory', {}).items()}
+		if not self.addresses: self.addresses = sorted(self.inventory)
+		if self.master.health is not None and 'health' in state: self.master.health.from_dict(state['health'])
+		
+	def _run(self):
+		next_poll = time.monotonic()
+		while not self._stop_event.is_set():
+			start = time.monotonic()
+			try:
+				if start >= next_poll:
+					next_poll = start + self.interval
+					self.poll_once()
+				elif self.alarm_interval:
+					self.poll_alarms_once()
+			except Exception as err:
+				_logger.exception(err)
+			wake = min(next_poll, start + self.alarm_interval) if self.alarm_interval else next_poll
+			self._stop_event.wait(max(0.0, wake - time.monotonic()))
 
 
+@contextmanager
+def _open_sink(options, fieldnames):
+	"""
+	usage: with _open_sink(options, fieldnames) as write: ...
+	Yields a function that writes one row (dict) to the output of the command line tool, as JSON lines or CSV.
+	An output file is closed at the end of the with block.
+	"""
+	import csv
+	import sys
+	out = sys.stdout if options.output == '-' else open(options.output, 'a', newline='')
+	try:
+		if options.format == 'csv':
+			writer = csv.DictWriter(out, fieldnames=fieldnames, extrasaction='ignore')
+			if out is sys.stdout or out.tell() == 0: writer.writeheader()
+			def write(row):
+				writer.writerow(row)
+				out.flush()
+		else:
+			def write(row):
+				out.write(json.dumps(row, default=str) + '\n')
+				out.flush()
+		yield write
+	finally:
+		if out is not sys.stdout: out.close()
+	
+def _field_rows(gateway, slave_address, results):
+	for field in results.get('fields', []):
+		yield dict(timestamp=results.get('timestamp', time.time()), gateway=gateway, address=slave_address, 
+					identification=results.get('identification'), descr=field['descr'], value=field['value'], unit=field['unit'])
+					
+def _gateway(text):
+	host, port = text.rsplit(':', 1)
+	return host, int(port)
 
-
-
+def _cmd_scan(options, write):
+	def scan(gateway):
+		master = MbusTcpMaster(*_gateway(gateway), baudrate=options.baudrate)
+		try:
+			for slave_address, fdh in (master.scan_slaves_primary(scan_timeout=options.scan_timeout, stop_at=options.stop_at) or {}).items():
+				write(dict(fdh, gateway=gateway, address=slave_address))
+		finally:
+			master.close()
+	threads = [threading.Thread(target=scan, args=(gateway,)) for gateway in options.gateways]
+	for thread in threads: thread.start()
+	for thread in threads: thread.join()
+
+def _cmd_read(options, write):
+	master = MbusTcpMaster(*_gateway(options.gateway), baudrate=options.baudrate)
+	try:
+		for slave_address in options.addresses:
+			results = master.get_all_fields(slave_address)
+			if results:
+				results['timestamp'] = time.time()
+				for row in _field_rows(options.gateway, slave_address, results): write(row)
+	finally:
+		master.close()
+		
+def _cmd_poll(options, write):
+	master = MbusTcpMaster(*_gateway(options.gateway), baudrate=options.baudrate, health=SlaveHealth())
+	poller = MbusPoller(master, options.addresses, interval=options.interval)
+	poller.add_listener(lambda slave_address, results: [write(row) for row in _field_rows(options.gateway, slave_address, results)])
+	try:
+		while options.count == 0 or poller.cycles < options.count:
+			start = time.monotonic()
+			poller.poll_once()
+			if options.count == 0 or poller.cycles < options.count: time.sleep(max(0.0, options.interval - (time.monotonic() - start)))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		master.close()
+		
+def _cmd_bench(options, write):
+	if options.capture:
+		# decode throughput: one telegram per line, as hex
+		with open(options.capture) as f:
+			lines = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+		parser = MbusSpecific()
+		# telegrams that do not decode are counted as failures once and left out of the timed runs
+		bodies = []
+		failures = 0
+		for line in lines:
+			try:
+				telegram = bytearray.fromhex(line)
+				body = telegram[7:-2] if telegram[0] == 0x68 else telegram
+			except (ValueError, IndexError):
+				body = None
+			if body is None or parser._parseVDS(body) is None:
+				_logger.warning(f'Capture line does not decode: {line[:40]}')
+				failures += 1
+			else:
+				bodies.append(body)
+		nr_fields = 0
+		start = time.perf_counter()
+		for _ in range(options.repeat):
+			for body in bodies: nr_fields += len(parser._parseVDS(body).get('fields', []))
+		duration = time.perf_counter() - start
+		nr_telegrams = len(bodies) * options.repeat
+		write(dict(bench='decode', telegrams=nr_telegrams, failures=failures, fields=nr_fields, seconds=round(duration, 6), 
+					telegrams_per_s=round(nr_telegrams / duration, 1) if duration else None, fields_per_s=round(nr_fields / duration, 1) if duration else None))
+	if options.gateway:
+		# transaction throughput against a gateway (or a simulator behind a TCP port)
+		master = MbusTcpMaster(*_gateway(options.gateway), baudrate=options.baudrate)
+		try:
+			latencies = []
+			failures = 0
+			start = time.perf_counter()
+			for _ in range(options.repeat):
+				for slave_address in options.addresses:
+					t = time.perf_counter()
+					if master.get_all_fields(slave_address): latencies.append(time.perf_counter() - t)
+					else: failures += 1
+			duration = time.perf_counter() - start
+			latencies.sort()
+			write(dict(bench='transaction', gateway=options.gateway, transactions=len(latencies), failures=failures, seconds=round(duration, 6), 
+						transactions_per_s=round(len(latencies) / duration, 2), 
+						latency_avg=round(sum(latencies) / len(latencies), 6) if latencies else None,
+						latency_p95=round(latencies[int(0.95 * (len(latencies) - 1))], 6) if latencies else None))
+		finally:
+			master.close()
 
 def main(args):
-	raise Exception ('Not an executable script...')
+	"""
+	usage: python MbusTcpMaster.py {scan,read,poll,bench} ... [--format {jsonl,csv}] [--output file]
+	
+	scan: Scan one or more gateways (host:port) in parallel for slaves on primary addresses
+	read: Read all fields of the given slaves once
+	poll: Read the given slaves every interval seconds
+	bench: Measure decode throughput (telegrams from a capture file) and/or transaction throughput against a gateway
+	"""
+	import argparse
+	parser = argparse.ArgumentParser(prog='MbusTcpMaster', description='Mbus master for TCP/Mbus bridges')
+	common = argparse.ArgumentParser(add_help=False)
+	common.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl', help='Output format')
+	common.add_argument('--output', default='-', help='Output file, - for stdout')
+	common.add_argument('--baudrate', type=int, default=2400, help='Baudrate of the Mbus')
+	common.add_argument('--loglevel', default='WARNING', help='Level of the log messages on stderr')
+	commands = parser.add_subparsers(dest='command', required=True)
+	
+	scan = commands.add_parser('scan', parents=[common], help='Scan gateways for slaves')
+	scan.add_argument('gateways', nargs='+', help='Gateways as host:port')
+	scan.add_argument('--scan-timeout', type=float, default=1.0)
+	scan.add_argument('--stop-at', type=int, default=250)
+	
+	read = commands.add_parser('read', parents=[common], help='Read all fields of slaves once')
+	read.add_argument('gateway', help='Gateway as host:port')
+	read.add_argument('addresses', type=int, nargs='+')
+	
+	poll = commands.add_parser('poll', parents=[common], help='Read slaves periodically')
+	poll.add_argument('gateway', help='Gateway as host:port')
+	poll.add_argument('addresses', type=int, nargs='+')
+	poll.add_argument('--interval', type=float, default=60.0, help='Seconds between the start of two cycles')
+	poll.add_argument('--count', type=int, default=0, help='Number of cycles, 0 for endless')
+	
+	bench = commands.add_parser('bench', parents=[common], help='Measure decode and/or transaction throughput')
+	bench.add_argument('--capture', help='File with one telegram per line in hex (RSP_UD long frame or its VDS part)')
+	bench.add_argument('--gateway', help='Gateway (or simulator) as host:port')
+	bench.add_argument('--addresses', type=int, nargs='+', default=[1])
+	bench.add_argument('--repeat', type=int, default=100)
+	
+	options = parser.parse_args(args[1:])
+	_logger.setLevel(options.loglevel.upper())
+	if options.command == 'bench' and not (options.capture or options.gateway): parser.error('bench needs --capture and/or --gateway')
+	
+	fieldnames = {'scan':['gateway', 'address', 'identification', 'manufacturer', 'version', 'medium', 'access_number', 'status', 'signature_hex'],
+				  'bench':['bench', 'gateway', 'telegrams', 'fields', 'transactions', 'failures', 'seconds', 'telegrams_per_s', 'fields_per_s', 
+						   'transactions_per_s', 'latency_avg', 'latency_p95']}.get(options.command, 
+						  ['timestamp', 'gateway', 'address', 'identification', 'descr', 'value', 'unit'])
+	with _open_sink(options, fieldnames) as write:
+		lock = threading.Lock()
+		def locked_write(row):
+			with lock: write(row)
+		{'scan':_cmd_scan, 'read':_cmd_read, 'poll':_cmd_poll, 'bench':_cmd_bench}[options.command](options, locked_write)
+	return 0
 
 if __name__ == '__main__':
 	import sys